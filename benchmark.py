@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import argparse
+import chromatics
+import common
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+# synthetic genome-scale fixtures and timings for the chromatics hot paths, runnable offline
+# peak memory is traced within this process, so it excludes bedtools subprocesses and joblib workers
+
+chrom_length = 2 * 10**8
+assays = ['CTCF', 'DNase', 'H3K27ac', 'H3K4me1', 'H3K4me3', 'RAD21', 'POLR2A', 'EP300']
+
+def get_random_intervals(count, mean_length, prefix, random_state):
+    starts = random_state.randint(0, chrom_length, count)
+    df = pd.DataFrame({
+        '{}_chrom'.format(prefix): random_state.choice(chromatics.chroms, count),
+        '{}_start'.format(prefix): starts,
+        '{}_end'.format(prefix): starts + random_state.randint(1, 2 * mean_length, count),
+        '{}_name'.format(prefix): ['{}{}'.format(prefix, _) for _ in range(count)]
+        })
+    return chromatics.sort_bed(df).reset_index(drop = True)
+
+def get_fixtures(scale, random_state = 0):
+    # enhancers and peaks at the full scale, promoters and loops an order of magnitude fewer like real data
+    random_state = np.random.RandomState(random_state)
+    enhancers_df = get_random_intervals(scale, 1000, 'enhancer', random_state)
+    promoters_df = get_random_intervals(max(scale // 10, 10), 2000, 'promoter', random_state)
+
+    peaks_df = get_random_intervals(scale, 500, 'peak', random_state)
+    peaks_df.columns = chromatics.generic_bed_columns
+    peaks_df['name'] = random_state.choice(assays, scale)
+    peaks_df['signal_value'] = random_state.exponential(5, scale)
+    peaks_df.columns = chromatics.signal_bed_columns
+
+    # loops between fragments up to 2mb apart on the same chromosome
+    interactions_df = get_random_intervals(max(scale // 10, 10), 5000, 'f1', random_state)
+    offsets = random_state.randint(common.min_enhancer_distance_to_promoter, common.max_enhancer_distance_to_promoter, len(interactions_df))
+    interactions_df['f2_chrom'] = interactions_df['f1_chrom']
+    interactions_df['f2_start'] = interactions_df['f1_start'] + offsets
+    interactions_df['f2_end'] = interactions_df['f1_end'] + offsets
+    interactions_df['f2_name'] = ['f2{}'.format(_) for _ in range(len(interactions_df))]
+    interactions_df['interaction_id'] = interactions_df['f1_name'] + '.' + interactions_df['f2_name']
+
+    pairs_df = chromatics.get_pairs_df(enhancers_df, promoters_df, random_state.randint(0, len(enhancers_df), scale), random_state.randint(0, len(promoters_df), scale))
+    windows_df = pairs_df[chromatics.enhancer_bed_columns + chromatics.promoter_bed_columns].copy()
+    common.add_enhancer_distance_to_promoter(windows_df)
+    windows_df = windows_df[['enhancer_chrom', 'window_start', 'window_end']]
+    return {'enhancers': enhancers_df, 'promoters': promoters_df, 'peaks': peaks_df, 'interactions': interactions_df, 'pairs': pairs_df, 'windows': windows_df}
+
+def benchmark_bedtools(fixtures, engine):
+    chromatics.bedtools('intersect -wa -wb', fixtures['enhancers'], fixtures['peaks'], right_names = chromatics.signal_bed_columns, engine = engine)
+
+def benchmark_average_signal_features(fixtures, engine):
+    dataset = chromatics.get_signal_store(fixtures['peaks']) if engine == 'store' else fixtures['peaks']
+    chromatics.generate_average_signal_features(fixtures['enhancers'], 'enhancer', dataset)
+
+def benchmark_prefix_sum_signal_features(fixtures, engine):
+    chromatics.generate_prefix_sum_signal_features(fixtures['enhancers'], 'enhancer', chromatics.get_signal_store(fixtures['peaks']))
+
+def benchmark_generate_training(fixtures, engine):
+    generators = [(chromatics.generate_prefix_sum_signal_features, chromatics.get_signal_store(fixtures['peaks']))]
+    chromatics.generate_training(fixtures['pairs'], ['enhancer', 'promoter'], generators, chunk_size = 2**14, n_jobs = 1, shared_memory = engine == 'shared_memory')
+
+def benchmark_interaction_elements(fixtures, engine):
+    chromatics.get_interaction_elements(
+        fixtures['interactions'],
+        'interaction_id',
+        ['f1_' + _ for _ in chromatics.generic_bed_columns],
+        ['f2_' + _ for _ in chromatics.generic_bed_columns],
+        fixtures['enhancers'],
+        fixtures['promoters'],
+        engine = engine)
+
+def benchmark_negative_sampling(fixtures, engine):
+    bins = np.linspace(common.min_enhancer_distance_to_promoter, common.max_enhancer_distance_to_promoter, 6)
+    # a counting pass sizes the sample to half of the sparsest bin
+    _, _, candidate_counts = chromatics.sample_distance_matched_pairs(fixtures['enhancers'], fixtures['promoters'], bins, 0)
+    chromatics.sample_distance_matched_pairs(fixtures['enhancers'], fixtures['promoters'], bins, min(candidate_counts) // 2)
+
+def benchmark_window_counts(fixtures, engine):
+    # interactions_in_window in generate_pairs.py, windows between the elements of each pair nest
+    chromatics.count_contained(fixtures['windows'], fixtures['windows'].iloc[::10])
+
+def benchmark_bed_io(fixtures, engine):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(temp_dir, 'peaks.bed.gz')
+        chromatics.write_bed(fixtures['peaks'], fn, compression = 'gzip')
+        if engine == 'typed':
+            chromatics.read_typed_bed(fn, chromatics.signal_bed_columns)
+        else:
+            chromatics.read_bed(fn, names = chromatics.signal_bed_columns)
+    finally:
+        shutil.rmtree(temp_dir)
+
+# (name, function, engines), engines only available with external tools are skipped when missing
+benchmarks = [
+    ('bedtools_intersect', benchmark_bedtools, ['native', 'subprocess']),
+    ('average_signal_features', benchmark_average_signal_features, ['store', 'subprocess']),
+    ('prefix_sum_signal_features', benchmark_prefix_sum_signal_features, ['store']),
+    ('generate_training', benchmark_generate_training, ['default', 'shared_memory']),
+    ('interaction_elements', benchmark_interaction_elements, ['sweep', 'native', 'subprocess']),
+    ('negative_sampling', benchmark_negative_sampling, ['default']),
+    ('window_counts', benchmark_window_counts, ['default']),
+    ('bed_io', benchmark_bed_io, ['typed', 'default'])
+    ]
+
+def run_benchmark(function, fixtures, engine, repeats):
+    # fastest of several runs, peak traced memory of the first
+    seconds = []
+    peak_memory = None
+    for repeat in range(repeats):
+        if repeat == 0:
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        function(fixtures, engine)
+        seconds.append(time.perf_counter() - start_time)
+        if repeat == 0:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return min(seconds), peak_memory
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', nargs = '+', type = float, default = [1e3, 1e4, 1e5], help = 'intervals per fixture, up to 1e7')
+    parser.add_argument('--benchmarks', nargs = '+', choices = [_[0] for _ in benchmarks])
+    parser.add_argument('--repeats', type = int, default = 3)
+    parser.add_argument('--output', default = 'benchmarks.csv', help = 'results are appended')
+    args = parser.parse_args()
+
+    commit = get_commit()
+    has_bedtools = shutil.which('bedtools') is not None
+    for scale in [int(_) for _ in args.scales]:
+        fixtures = get_fixtures(scale)
+        for name, function, engines in benchmarks:
+            if args.benchmarks is not None and name not in args.benchmarks:
+                continue
+            for engine in engines:
+                if engine == 'subprocess' and not has_bedtools:
+                    continue
+                seconds, peak_memory = run_benchmark(function, fixtures, engine, args.repeats)
+                results_df = pd.DataFrame([[commit, name, engine, scale, seconds, scale / seconds, peak_memory / 2**20]], columns = ['commit', 'benchmark', 'engine', 'scale', 'seconds', 'intervals_per_second', 'peak_mb'])
+                results_df.to_csv(args.output, mode = 'a', header = not os.path.exists(args.output), index = False)
+                print('{} {} {} {:.3f}s {:.1f}MB'.format(name, engine, scale, seconds, peak_memory / 2**20), flush = True)
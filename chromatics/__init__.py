@@ -1,7 +1,14 @@
 from .bedtools import *
+from .candidates import *
 from .feature_generator import *
+from .instrumentation import *
 from .interactions import *
+from .intervals import *
 from .samtools import *
+from .schema import *
+from .signal_store import *
+
+# chromatics.modeling, which imports most of scikit-learn, is imported explicitly by the scripts that model
 
 chroms = ['chr{}'.format(_) for _ in list(range(1, 22 + 1)) + ['X', 'Y']]
 
@@ -1,15 +1,65 @@
+import chromatics
+import glob
+import hashlib
 import io
+import numpy as np
 import os
 import pandas as pd
+import shutil
 import subprocess
 import tempfile
+import time
 
 def read_bed(x, **kwargs):
     return pd.read_csv(x, sep = r'\s+', header = None, index_col = False, **kwargs)
 
+def get_bed_dtypes(names):
+    # categorical chromosomes, 32-bit coordinates and signal, everything else is left to the parser
+    dtypes = {}
+    for name in names:
+        if name == 'chrom' or name.endswith('_chrom'):
+            dtypes[name] = 'category'
+        elif name in ['start', 'end'] or name.endswith('_start') or name.endswith('_end'):
+            dtypes[name] = np.int32
+        elif name in ['signal_value', 'percent_methylated', 'rpkm1', 'rpkm2']:
+            dtypes[name] = np.float32
+    return dtypes
+
+def read_typed_bed(fn, names, usecols = None, cache = False):
+    # tab-separated files only, which keeps pandas on the c parser unlike read_bed's regex separator
+    # the cache is a pickle next to fn keyed by its size and mtime plus the requested columns
+    if cache:
+        stat = os.stat(fn)
+        key = hashlib.sha1(repr((names, usecols, stat.st_size, stat.st_mtime_ns)).encode()).hexdigest()[:16]
+        cache_fn = '{}.{}.pkl'.format(fn, key)
+        if os.path.exists(cache_fn):
+            return pd.read_pickle(cache_fn)
+
+    df = pd.read_csv(fn, sep = '\t', header = None, index_col = False, names = names, usecols = usecols, dtype = get_bed_dtypes(usecols or names), engine = 'c')
+
+    if cache:
+        tmp_fn = '{}.{}.tmp'.format(cache_fn, os.getpid())
+        df.to_pickle(tmp_fn)
+        os.replace(tmp_fn, cache_fn)
+        remove_stale_caches(fn, cache_fn)
+    return df
+
+def remove_stale_caches(fn, current_cache_fn):
+    # caches written before fn was last modified belong to earlier versions of it,
+    # caches of the current version for other columns are kept
+    mtime_ns = os.stat(fn).st_mtime_ns
+    for cache_fn in glob.glob('{}.{}.pkl'.format(glob.escape(fn), '[0-9a-f]' * 16)):
+        try:
+            if cache_fn != current_cache_fn and os.stat(cache_fn).st_mtime_ns < mtime_ns:
+                os.remove(cache_fn)
+        except FileNotFoundError:
+            # removed concurrently
+            pass
+
 def write_bed(df, fn, **kwargs):
     df = df.copy()
-    df.iloc[:, [1, 2]] = df.iloc[:, [1, 2]].astype(int) # ensure coordinates are sorted as integer
+    for column in df.columns[[1, 2]]:
+        df[column] = df[column].astype(int) # ensure coordinates are sorted as integer
     df.sort_values(df.columns.tolist()[:3], inplace = True)
     df.to_csv(fn, sep = '\t', header = False, index = False, **kwargs)
 
@@ -18,7 +68,49 @@ def sort_bed(x):
         return x.sort_values(x.columns.tolist()[:3])
     raise Exception('Not a pandas DataFrame')
 
-def bedtools(operation, left_input, right_input = None, left_names = None, right_names = None):
+def get_bedtools_names(operation, left_names, right_names):
+    if operation.startswith('intersect'):
+        names = []
+        if operation.find('-wa') != -1:
+            names += left_names
+        if operation.find('-wb') != -1:
+            names += right_names
+        if operation.find('-wo') != -1 or operation.find('-wao') != -1:
+            names = left_names + right_names + ['overlap']
+        if operation.find('-c') != -1:
+            names = left_names + ['count']
+        if operation.find('-u') != -1:
+            names = left_names
+        if operation.find('-loj') != -1:
+            names = left_names + right_names
+    elif operation.startswith('merge'):
+        names = left_names
+    elif operation.startswith('closest'):
+        names = left_names + right_names
+        if operation.find('-d') != -1:
+            names.append('distance')
+    else:
+        names = left_names + right_names
+    return names
+
+def get_input_rows(x):
+    return len(x) if isinstance(x, pd.DataFrame) else None
+
+def bedtools(operation, left_input, right_input = None, left_names = None, right_names = None, engine = 'subprocess'):
+    # the native engine runs the supported operations in-process on numpy arrays
+    if engine == 'native':
+        with chromatics.time_event('bedtools', operation = operation, engine = engine, left_rows = get_input_rows(left_input), right_rows = get_input_rows(right_input)):
+            return chromatics.native_bedtools(operation, left_input, right_input, left_names, right_names)
+    elif engine != 'subprocess':
+        raise Exception('Unknown bedtools engine: {}'.format(engine))
+
+    with chromatics.time_event('bedtools', operation = operation, engine = engine, left_rows = get_input_rows(left_input), right_rows = get_input_rows(right_input)) as fields:
+        return run_bedtools(operation, left_input, right_input, left_names, right_names, fields)
+
+def run_bedtools(operation, left_input, right_input, left_names, right_names, fields):
+    # fields receives bytes piped each way and subprocess versus parse time
+    subprocess_start_time = time.perf_counter()
+
     # if first input is a dataframe, feed via stdin
     if isinstance(left_input, pd.DataFrame):
         left_input_fn = 'stdin'
@@ -49,7 +141,9 @@ def bedtools(operation, left_input, right_input = None, left_names = None, right
     if left_input_fn == 'stdin':
         left_input_buffer = io.StringIO()
         left_input.to_csv(left_input_buffer, sep = '\t', header = False, index = False)
-        stdout, _ = p.communicate(input = left_input_buffer.getvalue().encode('utf-8'))
+        stdin = left_input_buffer.getvalue().encode('utf-8')
+        fields['stdin_bytes'] = len(stdin)
+        stdout, _ = p.communicate(input = stdin)
     else:
         stdout, _ = p.communicate()
     assert p.returncode == 0
@@ -66,30 +160,42 @@ def bedtools(operation, left_input, right_input = None, left_names = None, right
     if isinstance(right_input, pd.DataFrame) and right_names is None:
         right_names = right_input.columns.tolist()
 
-    if operation.startswith('intersect'):
-        names = []
-        if operation.find('-wa') != -1:
-            names += left_names
-        if operation.find('-wb') != -1:
-            names += right_names
-        if operation.find('-wo') != -1 or operation.find('-wao') != -1:
-            names = left_names + right_names + ['overlap']
-        if operation.find('-c') != -1:
-            names = left_names + ['count']
-        if operation.find('-u') != -1:
-            names = left_names
-        if operation.find('-loj') != -1:
-            names = left_names + right_names
-    elif operation.startswith('merge'):
-        names = left_names
-    elif operation.startswith('closest'):
-        names = left_names + right_names
-        if operation.find('-d') != -1:
-            names.append('distance')
-    else:
-        names = left_names + right_names
+    names = get_bedtools_names(operation, left_names, right_names)
+    fields['stdout_bytes'] = len(stdout)
+    fields['subprocess_seconds'] = time.perf_counter() - subprocess_start_time
 
     # create dataframe from bedtools output stored in stdout
+    parse_start_time = time.perf_counter()
     if len(stdout) == 0:
-        return pd.DataFrame(columns = names)
-    return read_bed(io.StringIO(stdout.decode('utf-8')), names = names)
+        result_df = pd.DataFrame(columns = names)
+    else:
+        result_df = read_bed(io.StringIO(stdout.decode('utf-8')), names = names)
+    fields['parse_seconds'] = time.perf_counter() - parse_start_time
+    return result_df
+
+def test_read_typed_bed():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fn = os.path.join(temp_dir, 'peaks.narrowPeak.gz')
+        shutil.copy('wgEncodeAwgDnaseUwdukeK562UniPk.narrowPeak.gz', fn)
+        usecols = ['chrom', 'start', 'end', 'signal_value']
+        expected_df = read_bed(fn, names = chromatics.narrowpeak_bed_columns, usecols = usecols)
+
+        for i in range(2):
+            typed_df = read_typed_bed(fn, chromatics.narrowpeak_bed_columns, usecols = usecols, cache = True)
+            assert typed_df['chrom'].dtype == 'category'
+            assert typed_df['start'].dtype == np.int32 and typed_df['signal_value'].dtype == np.float32
+            assert (typed_df['chrom'].astype(str) == expected_df['chrom']).all()
+            assert (typed_df[['start', 'end']].values == expected_df[['start', 'end']].values).all()
+            assert np.allclose(typed_df['signal_value'], expected_df['signal_value'])
+        assert len([_ for _ in os.listdir(temp_dir) if _.endswith('.pkl')]) == 1
+
+        # a cache for other columns is kept, caches of a replaced file are not
+        read_typed_bed(fn, chromatics.narrowpeak_bed_columns, usecols = usecols[:3], cache = True)
+        assert len([_ for _ in os.listdir(temp_dir) if _.endswith('.pkl')]) == 2
+        mtime_ns = max(os.stat(os.path.join(temp_dir, _)).st_mtime_ns for _ in os.listdir(temp_dir)) + 10**9
+        os.utime(fn, ns = (mtime_ns, mtime_ns))
+        read_typed_bed(fn, chromatics.narrowpeak_bed_columns, usecols = usecols, cache = True)
+        assert len([_ for _ in os.listdir(temp_dir) if _.endswith('.pkl')]) == 1
+
+if __name__ == '__main__':
+    test_read_typed_bed()
@@ -0,0 +1,315 @@
+import chromatics
+import numpy as np
+import pandas as pd
+
+# enhancer-promoter candidates within a distance band, found with binary searches over sorted promoter coordinates
+# distances follow common.add_enhancer_distance_to_promoter: the length of the window between the two regions,
+# so a promoter downstream of an enhancer is at promoter_start - enhancer_end - 2 and one upstream at enhancer_start - promoter_end - 2
+
+def get_candidate_bounds(enhancer_starts, enhancer_ends, promoter_starts, promoter_ends, min_distance, max_distance, include_min = False, include_max = False):
+    # promoter_starts and promoter_ends must each be sorted, returns [lower, upper) index bounds into them
+    # for promoters downstream (by start) and upstream (by end) of each enhancer
+    assert 0 <= min_distance <= max_distance
+
+    downstream_lower = np.searchsorted(promoter_starts, enhancer_ends + 2 + min_distance, side = 'left' if include_min else 'right')
+    downstream_upper = np.searchsorted(promoter_starts, enhancer_ends + 2 + max_distance, side = 'right' if include_max else 'left')
+    upstream_lower = np.searchsorted(promoter_ends, enhancer_starts - 2 - max_distance, side = 'left' if include_max else 'right')
+    upstream_upper = np.searchsorted(promoter_ends, enhancer_starts - 2 - min_distance, side = 'right' if include_min else 'left')
+
+    return (downstream_lower, downstream_upper), (upstream_lower, upstream_upper)
+
+def get_domain_index(domains_df):
+    # domains of each chromosome sorted by start with the running maximum of their ends: a span lies within
+    # a single domain iff the largest end among domains starting at or before the span reaches the span end
+    # nested and overlapping domains (like arrowhead's) need no merging
+    chroms, starts, ends = chromatics.get_coordinates(domains_df)
+    domain_index = {}
+    for chrom in pd.unique(chroms):
+        positions = np.flatnonzero(chroms == chrom)
+        positions = positions[np.argsort(starts[positions], kind = 'mergesort')]
+        domain_index[chrom] = (starts[positions], np.maximum.accumulate(ends[positions]))
+    return domain_index
+
+def get_same_domain(domain_index, chroms, span_starts, span_ends):
+    same_domain = np.zeros(len(chroms), dtype = bool)
+    for chrom in pd.unique(chroms):
+        if chrom not in domain_index:
+            continue
+        positions = np.flatnonzero(chroms == chrom)
+        domain_starts, max_ends = domain_index[chrom]
+        domain_bounds = np.searchsorted(domain_starts, span_starts[positions], side = 'right') - 1
+        same_domain[positions] = (domain_bounds >= 0) & (max_ends[np.maximum(domain_bounds, 0)] >= span_ends[positions])
+    return same_domain
+
+def get_pair_same_domain(domain_index, enhancers_df, promoters_df, enhancer_indices, promoter_indices):
+    # whether each enhancer and promoter (on the same chromosome) lie within one domain
+    enhancer_chroms, enhancer_starts, enhancer_ends = chromatics.get_coordinates(enhancers_df)
+    _, promoter_starts, promoter_ends = chromatics.get_coordinates(promoters_df)
+    return get_same_domain(
+        domain_index,
+        enhancer_chroms[enhancer_indices],
+        np.minimum(enhancer_starts[enhancer_indices], promoter_starts[promoter_indices]),
+        np.maximum(enhancer_ends[enhancer_indices], promoter_ends[promoter_indices]))
+
+def get_pairs_same_domain(domain_index, pairs_df):
+    pair_indices = np.arange(len(pairs_df))
+    return get_pair_same_domain(domain_index, pairs_df[chromatics.enhancer_bed_columns], pairs_df[chromatics.promoter_bed_columns], pair_indices, pair_indices)
+
+def get_chrom_candidates(enhancers_df, promoters_df):
+    # yields (enhancer positions, promoter positions sorted by start, promoter positions sorted by end) per chromosome
+    enhancer_chroms, _, _ = chromatics.get_coordinates(enhancers_df)
+    promoter_chroms, promoter_starts, promoter_ends = chromatics.get_coordinates(promoters_df)
+    for chrom, enhancer_positions, promoter_positions in chromatics.get_chrom_groups(enhancer_chroms, promoter_chroms):
+        by_start = promoter_positions[np.argsort(promoter_starts[promoter_positions], kind = 'mergesort')]
+        by_end = promoter_positions[np.argsort(promoter_ends[promoter_positions], kind = 'mergesort')]
+        yield chrom, enhancer_positions, by_start, by_end
+
+def iter_candidate_pairs(enhancers_df, promoters_df, min_distance, max_distance, batch_size = 2**16, domain_index = None, same_domain_only = False):
+    # streams every enhancer-promoter pair with min_distance < distance < max_distance in batches of at most
+    # batch_size pairs (or a single enhancer's pairs if larger), without building the per-chromosome cross join
+    # with a domain_index, pairs get a same_domain column, and with same_domain_only the other pairs are dropped
+    _, enhancer_starts, enhancer_ends = chromatics.get_coordinates(enhancers_df)
+    _, promoter_starts, promoter_ends = chromatics.get_coordinates(promoters_df)
+
+    for chrom, enhancer_positions, by_start, by_end in get_chrom_candidates(enhancers_df, promoters_df):
+        enhancer_positions = enhancer_positions[np.argsort(enhancer_starts[enhancer_positions], kind = 'mergesort')]
+        downstream, upstream = get_candidate_bounds(
+            enhancer_starts[enhancer_positions],
+            enhancer_ends[enhancer_positions],
+            promoter_starts[by_start],
+            promoter_ends[by_end],
+            min_distance,
+            max_distance)
+        pair_counts = (downstream[1] - downstream[0]) + (upstream[1] - upstream[0])
+        cumulative_counts = np.cumsum(pair_counts)
+
+        # cut the sorted enhancers into runs whose pair counts fit in a batch
+        batch_lower_bound = 0
+        while batch_lower_bound < len(enhancer_positions):
+            previous_count = cumulative_counts[batch_lower_bound - 1] if batch_lower_bound > 0 else 0
+            batch_upper_bound = max(np.searchsorted(cumulative_counts, previous_count + batch_size, side = 'right'), batch_lower_bound + 1)
+            batch = slice(batch_lower_bound, batch_upper_bound)
+            batch_lower_bound = batch_upper_bound
+
+            downstream_owners, downstream_candidates = chromatics.expand_ranges(downstream[0][batch], downstream[1][batch])
+            upstream_owners, upstream_candidates = chromatics.expand_ranges(upstream[0][batch], upstream[1][batch])
+            pair_enhancers = enhancer_positions[batch][np.concatenate([downstream_owners, upstream_owners])]
+            pair_promoters = np.concatenate([by_start[downstream_candidates], by_end[upstream_candidates]])
+            if len(pair_enhancers) == 0:
+                continue
+
+            if domain_index is not None:
+                same_domain = get_pair_same_domain(domain_index, enhancers_df, promoters_df, pair_enhancers, pair_promoters)
+                if same_domain_only:
+                    pair_enhancers = pair_enhancers[same_domain]
+                    pair_promoters = pair_promoters[same_domain]
+                    same_domain = same_domain[same_domain]
+                    if len(pair_enhancers) == 0:
+                        continue
+
+            order = np.lexsort((promoter_starts[pair_promoters], pair_enhancers))
+            pairs_df = get_pairs_df(enhancers_df, promoters_df, pair_enhancers[order], pair_promoters[order])
+            if domain_index is not None:
+                pairs_df['same_domain'] = same_domain[order]
+            yield pairs_df
+
+def sample_without_replacement(population_size, sample_size, random_state):
+    # rejection sampling keeps memory proportional to the sample rather than the population
+    if sample_size > population_size:
+        raise Exception('Cannot sample {} of {} candidates'.format(sample_size, population_size))
+    samples = np.array([], dtype = np.int64)
+    while len(samples) < sample_size:
+        samples = np.unique(np.concatenate([samples, random_state.randint(0, population_size, sample_size - len(samples))]))
+    return samples[random_state.permutation(len(samples))]
+
+def get_bin_segments(enhancers_df, promoters_df, min_distance, max_distance, include_min, include_max):
+    # candidates in one distance bin as contiguous segments of promoter orderings, two segments (downstream, upstream) per enhancer
+    _, enhancer_starts, enhancer_ends = chromatics.get_coordinates(enhancers_df)
+    _, promoter_starts, promoter_ends = chromatics.get_coordinates(promoters_df)
+
+    segment_enhancers, segment_lower_bounds, segment_counts, orders = [], [], [], []
+    order_offset = 0
+    for chrom, enhancer_positions, by_start, by_end in get_chrom_candidates(enhancers_df, promoters_df):
+        downstream, upstream = get_candidate_bounds(
+            enhancer_starts[enhancer_positions],
+            enhancer_ends[enhancer_positions],
+            promoter_starts[by_start],
+            promoter_ends[by_end],
+            min_distance,
+            max_distance,
+            include_min,
+            include_max)
+        segment_enhancers += [enhancer_positions, enhancer_positions]
+        segment_lower_bounds += [downstream[0] + order_offset, upstream[0] + order_offset + len(by_start)]
+        segment_counts += [np.maximum(downstream[1] - downstream[0], 0), np.maximum(upstream[1] - upstream[0], 0)]
+        orders += [by_start, by_end]
+        order_offset += len(by_start) + len(by_end)
+
+    if len(orders) == 0:
+        return np.array([], dtype = np.int64), np.array([], dtype = np.int64), np.array([], dtype = np.int64), np.array([], dtype = np.int64)
+    return np.concatenate(segment_enhancers), np.concatenate(segment_lower_bounds), np.concatenate(segment_counts), np.concatenate(orders)
+
+def sample_distance_matched_pairs(enhancers_df, promoters_df, bins, samples_per_bin, excluded_pairs = None, random_state = 0, domain_index = None, same_domain = None):
+    # draws samples_per_bin (a number, or one per bin) enhancer-promoter pairs uniformly from each distance bin
+    # (edges as returned by pd.qcut, first bin closed, others half-open on the left) without materializing the candidates
+    # excluded_pairs is a tuple of enhancer and promoter positions, compared through int64 pair keys
+    # with a domain_index and same_domain set, only pairs within one domain (or only pairs across domains) are kept
+    # returns sampled enhancer positions, promoter positions, and the number of candidates per bin before either filter
+    random_state = np.random.RandomState(random_state)
+    samples_per_bin = np.broadcast_to(samples_per_bin, len(bins) - 1)
+    excluded_keys = np.array([], dtype = np.int64)
+    if excluded_pairs is not None:
+        excluded_keys = np.unique(np.asarray(excluded_pairs[0], dtype = np.int64) * len(promoters_df) + np.asarray(excluded_pairs[1], dtype = np.int64))
+
+    enhancer_indices, promoter_indices, candidate_counts = [], [], []
+    for bin_number in range(len(bins) - 1):
+        segment_enhancers, segment_lower_bounds, segment_counts, orders = get_bin_segments(
+            enhancers_df,
+            promoters_df,
+            bins[bin_number],
+            bins[bin_number + 1],
+            include_min = bin_number == 0,
+            include_max = True)
+        cumulative_counts = np.cumsum(segment_counts)
+        candidate_count = int(cumulative_counts[-1]) if len(cumulative_counts) > 0 else 0
+        candidate_counts.append(candidate_count)
+
+        # map flat candidate numbers to (segment, offset), redraw until enough non-excluded pairs are found
+        drawn = np.array([], dtype = np.int64)
+        accepted_enhancers = np.array([], dtype = np.int64)
+        accepted_promoters = np.array([], dtype = np.int64)
+        while len(accepted_enhancers) < samples_per_bin[bin_number]:
+            remaining = samples_per_bin[bin_number] - len(accepted_enhancers)
+            if len(drawn) + remaining > candidate_count:
+                raise Exception('Cannot sample {} pairs from distance bin {}'.format(samples_per_bin[bin_number], bin_number))
+            samples = sample_without_replacement(candidate_count - len(drawn), remaining, random_state)
+
+            # skip over candidates drawn in earlier rounds so each round samples only from the rest
+            for previous in np.sort(drawn):
+                samples[samples >= previous] += 1
+            drawn = np.concatenate([drawn, samples])
+
+            segments = np.searchsorted(cumulative_counts, samples, side = 'right')
+            offsets = samples - (cumulative_counts[segments] - segment_counts[segments])
+            sampled_enhancers = segment_enhancers[segments]
+            sampled_promoters = orders[segment_lower_bounds[segments] + offsets]
+
+            keep = ~np.isin(sampled_enhancers * len(promoters_df) + sampled_promoters, excluded_keys)
+            if domain_index is not None and same_domain is not None:
+                keep &= get_pair_same_domain(domain_index, enhancers_df, promoters_df, sampled_enhancers, sampled_promoters) == same_domain
+            accepted_enhancers = np.concatenate([accepted_enhancers, sampled_enhancers[keep]])
+            accepted_promoters = np.concatenate([accepted_promoters, sampled_promoters[keep]])
+
+        enhancer_indices.append(accepted_enhancers)
+        promoter_indices.append(accepted_promoters)
+
+    return np.concatenate(enhancer_indices), np.concatenate(promoter_indices), np.array(candidate_counts)
+
+def get_pairs_df(enhancers_df, promoters_df, enhancer_indices, promoter_indices):
+    return pd.concat([
+        enhancers_df.iloc[enhancer_indices].reset_index(drop = True),
+        promoters_df.iloc[promoter_indices].reset_index(drop = True)
+        ], axis = 1)
+
+def test_iter_candidate_pairs():
+    enhancers_df = chromatics.read_bed('enhancers.bed', names = chromatics.enhancer_bed_columns)
+    promoters_df = chromatics.read_bed('promoters.bed', names = chromatics.promoter_bed_columns)
+    candidates_df = pd.concat(list(iter_candidate_pairs(enhancers_df, promoters_df, 1000, 20000, batch_size = 1)), ignore_index = True)
+    print(candidates_df)
+    assert candidates_df[['enhancer_name', 'promoter_name']].values.tolist() == [['enhancer1', 'promoter3'], ['enhancer1', 'promoter1'], ['enhancer2', 'promoter2']]
+
+    # compare against the cross join used by generate_pairs.py
+    random_state = np.random.RandomState(0)
+    starts = random_state.randint(0, 10**6, 2000)
+    random_df = pd.DataFrame({'chrom': random_state.choice(['chr1', 'chr2'], 2000), 'start': starts, 'end': starts + random_state.randint(1, 5000, 2000)})
+    random_df['name'] = random_df.index.astype(str)
+    random_enhancers_df = random_df.iloc[:1000].copy()
+    random_promoters_df = random_df.iloc[1000:].copy()
+    random_enhancers_df.columns = chromatics.enhancer_bed_columns
+    random_promoters_df.columns = chromatics.promoter_bed_columns
+
+    cross_df = pd.merge(random_enhancers_df, random_promoters_df, left_on = 'enhancer_chrom', right_on = 'promoter_chrom')
+    cross_df['window_start'] = cross_df[['promoter_end', 'enhancer_end']].min(axis = 1) + 1
+    cross_df['window_end'] = cross_df[['promoter_start', 'enhancer_start']].max(axis = 1) - 1
+    non_overlapping_mask = cross_df.eval('promoter_end < enhancer_start or enhancer_end < promoter_start')
+    cross_df['distance'] = np.where(non_overlapping_mask, cross_df['window_end'] - cross_df['window_start'], 0)
+    expected = set(map(tuple, cross_df.query('10000 < distance < 200000')[['enhancer_name', 'promoter_name']].values))
+
+    batches = list(iter_candidate_pairs(random_enhancers_df, random_promoters_df, 10000, 200000, batch_size = 5000))
+    assert all(len(_) <= 5000 for _ in batches)
+    observed = [tuple(_) for batch_df in batches for _ in batch_df[['enhancer_name', 'promoter_name']].values]
+    assert len(observed) == len(set(observed)) and set(observed) == expected
+
+def test_sample_distance_matched_pairs():
+    random_state = np.random.RandomState(0)
+    starts = random_state.randint(0, 10**6, 2000)
+    random_df = pd.DataFrame({'chrom': random_state.choice(['chr1', 'chr2'], 2000), 'start': starts, 'end': starts + random_state.randint(1, 5000, 2000)})
+    random_df['name'] = random_df.index.astype(str)
+    random_enhancers_df = random_df.iloc[:1000].copy()
+    random_promoters_df = random_df.iloc[1000:].copy()
+    random_enhancers_df.columns = chromatics.enhancer_bed_columns
+    random_promoters_df.columns = chromatics.promoter_bed_columns
+
+    bins = np.array([10000, 50000.5, 120000, 400000])
+    excluded_pairs = (np.arange(500), np.arange(500))
+    enhancer_indices, promoter_indices, candidate_counts = sample_distance_matched_pairs(random_enhancers_df, random_promoters_df, bins, 100, excluded_pairs)
+    sample_df = get_pairs_df(random_enhancers_df, random_promoters_df, enhancer_indices, promoter_indices)
+    print(candidate_counts)
+
+    # same seed, same sample
+    repeated_enhancer_indices, repeated_promoter_indices, _ = sample_distance_matched_pairs(random_enhancers_df, random_promoters_df, bins, 100, excluded_pairs)
+    assert (enhancer_indices == repeated_enhancer_indices).all() and (promoter_indices == repeated_promoter_indices).all()
+
+    sample_df['window_start'] = sample_df[['promoter_end', 'enhancer_end']].min(axis = 1) + 1
+    sample_df['window_end'] = sample_df[['promoter_start', 'enhancer_start']].max(axis = 1) - 1
+    sample_df['bin'] = pd.cut(sample_df.eval('window_end - window_start'), bins, include_lowest = True)
+    assert (sample_df['bin'].value_counts() == 100).all()
+    assert not sample_df.duplicated(['enhancer_name', 'promoter_name']).any()
+    assert not (enhancer_indices == promoter_indices).any()
+
+    candidate_df = pd.concat(list(iter_candidate_pairs(random_enhancers_df, random_promoters_df, 0, 400001)), ignore_index = True)
+    candidate_df['distance'] = candidate_df[['promoter_start', 'enhancer_start']].max(axis = 1) - candidate_df[['promoter_end', 'enhancer_end']].min(axis = 1) - 2
+    assert candidate_counts.tolist() == pd.cut(candidate_df['distance'], bins, include_lowest = True).value_counts(sort = False).tolist()
+
+def test_same_domain():
+    random_state = np.random.RandomState(0)
+    starts = random_state.randint(0, 10**6, 2000)
+    random_df = pd.DataFrame({'chrom': random_state.choice(['chr1', 'chr2'], 2000), 'start': starts, 'end': starts + random_state.randint(1, 5000, 2000)})
+    random_df['name'] = random_df.index.astype(str)
+    random_enhancers_df = random_df.iloc[:1000].copy()
+    random_promoters_df = random_df.iloc[1000:].copy()
+    random_enhancers_df.columns = chromatics.enhancer_bed_columns
+    random_promoters_df.columns = chromatics.promoter_bed_columns
+
+    # nested and overlapping domains, none on chr2 beyond the first 100kb
+    domain_starts = random_state.randint(0, 10**6, 60)
+    domains_df = pd.DataFrame({'chrom': ['chr1'] * 50 + ['chr2'] * 10, 'start': domain_starts, 'end': domain_starts + random_state.randint(10**4, 3 * 10**5, 60)})
+    domains_df.loc[50:, 'start'] //= 10
+    domains_df.loc[50:, 'end'] = domains_df.loc[50:, 'start'] + 10**4
+    domain_index = get_domain_index(domains_df)
+
+    candidates_df = pd.concat(list(iter_candidate_pairs(random_enhancers_df, random_promoters_df, 1000, 200000, domain_index = domain_index)), ignore_index = True)
+    span_starts = candidates_df[['enhancer_start', 'promoter_start']].min(axis = 1).values
+    span_ends = candidates_df[['enhancer_end', 'promoter_end']].max(axis = 1).values
+    expected = np.zeros(len(candidates_df), dtype = bool)
+    for domain in domains_df.itertuples():
+        expected |= (candidates_df['enhancer_chrom'].values == domain.chrom) & (domain.start <= span_starts) & (span_ends <= domain.end)
+    assert 0 < expected.sum() < len(expected)
+    assert (candidates_df['same_domain'].values == expected).all()
+    assert (get_pairs_same_domain(domain_index, candidates_df) == expected).all()
+
+    restricted_df = pd.concat(list(iter_candidate_pairs(random_enhancers_df, random_promoters_df, 1000, 200000, batch_size = 100, domain_index = domain_index, same_domain_only = True)), ignore_index = True)
+    assert restricted_df['same_domain'].all()
+    assert set(restricted_df['enhancer_name'] + '.' + restricted_df['promoter_name']) == set((candidates_df['enhancer_name'] + '.' + candidates_df['promoter_name'])[expected])
+
+    # sampling within and across domains, with a number of samples per bin
+    bins = np.array([1000, 50000, 200000])
+    for same_domain in [True, False]:
+        enhancer_indices, promoter_indices, _ = sample_distance_matched_pairs(random_enhancers_df, random_promoters_df, bins, [20, 10], domain_index = domain_index, same_domain = same_domain)
+        assert len(enhancer_indices) == 30
+        assert (get_pair_same_domain(domain_index, random_enhancers_df, random_promoters_df, enhancer_indices, promoter_indices) == same_domain).all()
+
+if __name__ == '__main__':
+    test_iter_candidate_pairs()
+    test_sample_distance_matched_pairs()
+    test_same_domain()
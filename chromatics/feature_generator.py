@@ -1,15 +1,24 @@
 #!/usr/bin/env python
 
 import chromatics
+import functools
+import json
 import numpy as np
+import os
 import pandas as pd
+import shutil
 import sklearn.externals.joblib as joblib
+import tempfile
 
 def generate_average_signal_features(chunk_df, region, dataset):
     assert (chunk_df[region + '_end'] > chunk_df[region + '_start']).all()
 
     region_bed_columns = ['{}_{}'.format(region, _) for _ in chromatics.generic_bed_columns]
-    signal_df = chromatics.bedtools('intersect -wa -wb', chunk_df[region_bed_columns].drop_duplicates(region + '_name'), dataset, right_names = chromatics.signal_bed_columns)
+    regions_df = chunk_df[region_bed_columns].drop_duplicates(region + '_name')
+    if isinstance(dataset, chromatics.SignalStore):
+        signal_df = dataset.intersect(regions_df)
+    else:
+        signal_df = chromatics.bedtools('intersect -wa -wb', regions_df, dataset, right_names = chromatics.signal_bed_columns)
 
     group_columns = ['{}_{}'.format(region, _) for _ in ['name', 'start', 'end']] + ['dataset']
     average_signal_df = signal_df.groupby(group_columns, sort = False, as_index = False).aggregate({'signal_value': sum})
@@ -18,38 +27,335 @@ def generate_average_signal_features(chunk_df, region, dataset):
 
     return average_signal_df.pivot_table(index = region + '_name', columns = 'dataset', values = 'signal_value')
 
-def generate_chunk_features(pairs_df, regions, generators, chunk_size, chunk_number, max_chunks):
+def generate_prefix_sum_signal_features(chunk_df, region, dataset):
+    # same output as generate_average_signal_features, but each region sum costs two binary searches per dataset
+    # instead of materializing every region x interval overlap
+    assert (chunk_df[region + '_end'] > chunk_df[region + '_start']).all()
+
+    if not isinstance(dataset, chromatics.SignalStore):
+        dataset = chromatics.get_signal_store(dataset)
+
+    region_bed_columns = ['{}_{}'.format(region, _) for _ in chromatics.generic_bed_columns]
+    regions_df = chunk_df[region_bed_columns].drop_duplicates(region + '_name')
+    sums, counts = dataset.get_signal_sums(regions_df)
+
+    region_lengths = (regions_df[region + '_end'] - regions_df[region + '_start']).values
+    average_signal = np.where(counts > 0, sums / region_lengths[:, np.newaxis], np.nan)
+    average_signal_df = pd.DataFrame(
+        average_signal,
+        index = pd.Index(regions_df[region + '_name'].values, name = region + '_name'),
+        columns = pd.Index(['{} ({})'.format(_, region) for _ in dataset.datasets], name = 'dataset'))
+
+    # match pivot_table, which drops regions and datasets without any overlap and sorts both axes
+    average_signal_df = average_signal_df.dropna(how = 'all').dropna(axis = 1, how = 'all')
+    return average_signal_df.sort_index().sort_index(axis = 1)
+
+def get_flank_label(flank_size):
+    return '{:g}kb'.format(flank_size / 1000) if flank_size >= 1000 else '{}bp'.format(flank_size)
+
+def generate_flank_signal_features(chunk_df, region, dataset, flank_sizes):
+    # generate_prefix_sum_signal_features for the regions and for the regions extended by each flank size
+    # (like enhancer_extension_size), in one pass over each dataset with columns like 'H3K27ac (enhancer±3kb)'
+    # bind flank_sizes with functools.partial to use it as a generator
+    assert (chunk_df[region + '_end'] > chunk_df[region + '_start']).all()
+
+    if not isinstance(dataset, chromatics.SignalStore):
+        dataset = chromatics.get_signal_store(dataset)
+
+    region_bed_columns = ['{}_{}'.format(region, _) for _ in chromatics.generic_bed_columns]
+    regions_df = chunk_df[region_bed_columns].drop_duplicates(region + '_name')
+    flank_sizes = [0] + list(flank_sizes)
+    sums, counts = dataset.get_flank_signal_sums(regions_df, flank_sizes)
+
+    region_lengths = (regions_df[region + '_end'] - regions_df[region + '_start']).values
+    scale_dfs = []
+    for i, flank_size in enumerate(flank_sizes):
+        scale = region if flank_size == 0 else '{}±{}'.format(region, get_flank_label(flank_size))
+        average_signal = np.where(counts[i] > 0, sums[i] / (region_lengths + 2 * flank_size)[:, np.newaxis], np.nan)
+        scale_dfs.append(pd.DataFrame(
+            average_signal,
+            index = pd.Index(regions_df[region + '_name'].values, name = region + '_name'),
+            columns = pd.Index(['{} ({})'.format(_, scale) for _ in dataset.datasets], name = 'dataset')))
+
+    average_signal_df = pd.concat(scale_dfs, axis = 1).dropna(how = 'all').dropna(axis = 1, how = 'all')
+    return average_signal_df.sort_index().sort_index(axis = 1)
+
+def get_generator_function(generator):
+    return generator.func if isinstance(generator, functools.partial) else generator
+
+def get_generator_columns(generator, dataset_name, region):
+    # feature columns a generator can produce for one dataset name
+    if get_generator_function(generator) is generate_flank_signal_features:
+        flank_sizes = [0] + list(generator.keywords['flank_sizes'])
+        return ['{} ({})'.format(dataset_name, region if _ == 0 else '{}±{}'.format(region, get_flank_label(_))) for _ in flank_sizes]
+    return ['{} ({})'.format(dataset_name, region)]
+
+def get_unique_regions(pairs_df, region):
+    region_bed_columns = ['{}_{}'.format(region, _) for _ in chromatics.generic_bed_columns]
+    return pairs_df[region_bed_columns].drop_duplicates(region + '_name').reset_index(drop = True)
+
+def apply_generators(chunk_df, region, generators):
+    region_features = []
+    for generator, dataset in generators:
+        with chromatics.time_event('generator', generator = get_generator_function(generator).__name__, region = region, rows = len(chunk_df)):
+            region_features.append(generator(chunk_df, region, dataset))
+    if len(region_features) == 0:
+        return pd.DataFrame(index = pd.Index([], name = region + '_name'))
+    return pd.concat(region_features, axis = 1)
+
+def get_sorted_regions(pairs_df, region):
+    # unique regions in genomic order, so each chunk covers a contiguous span of one chromosome
+    regions_df = get_unique_regions(pairs_df, region)
+    chroms = np.asarray(regions_df[region + '_chrom']).astype(str)
+    order = np.lexsort((regions_df[region + '_start'].values, chroms))
+    return regions_df.iloc[order].reset_index(drop = True)
+
+def get_chunk_bounds(regions_df, region, chunk_size):
+    # (lower, upper) row bounds of chunks of at most chunk_size sorted regions, split where the chromosome changes
+    chroms = np.asarray(regions_df[region + '_chrom']).astype(str)
+    chrom_bounds = np.r_[0, np.flatnonzero(chroms[1:] != chroms[:-1]) + 1, len(chroms)]
+    return [
+        (chunk_lower_bound, min(chunk_lower_bound + chunk_size, chrom_upper_bound))
+        for chrom_lower_bound, chrom_upper_bound in zip(chrom_bounds[:-1], chrom_bounds[1:])
+        for chunk_lower_bound in range(chrom_lower_bound, chrom_upper_bound, chunk_size)]
+
+def split_generators(generators):
+    # signal tables held in memory are split by chromosome once, so each chunk is sent only its chromosome's intervals
+    # stores and files are sent as they are, workers only read the blocks of chromosomes they need
+    split = []
+    for generator, dataset in generators:
+        if isinstance(dataset, pd.DataFrame):
+            dataset = dict(list(dataset.groupby(np.asarray(dataset.iloc[:, 0]).astype(str), sort = False)))
+        split.append((generator, dataset))
+    return split
+
+def get_chrom_generators(split, chrom):
+    # a generator without any intervals on the chromosome cannot produce features for it and is left out
+    return [(generator, dataset[chrom] if isinstance(dataset, dict) else dataset) for generator, dataset in split if not isinstance(dataset, dict) or chrom in dataset]
+
+def generate_chunk_features(chunk_df, region, generators, chunk_number, max_chunks):
     print(chunk_number, max_chunks - 1)
+    assert len(chunk_df) > 0
 
-    chunk_lower_bound = chunk_number * chunk_size
-    chunk_upper_bound = chunk_lower_bound + chunk_size
-    chunk_df = pairs_df.iloc[chunk_lower_bound:chunk_upper_bound]
-    assert 0 < len(chunk_df) <= chunk_size
+    with chromatics.time_event('chunk', region = region, chunk_number = chunk_number, rows = len(chunk_df)):
+        return apply_generators(chunk_df, region, generators)
 
-    index_columns = ['{}_name'.format(region) for region in regions]
-    features_df = chunk_df[index_columns]
-    for region in regions:
-        region_features = [generator(chunk_df, region, dataset) for generator, dataset in generators]
-        region_features_df = pd.concat(region_features, axis = 1)
-        features_df = pd.merge(features_df, region_features_df, left_on = '{}_name'.format(region), right_index = True, how = 'left')
-    return features_df.set_index(index_columns)
+def share_regions(regions_df, region, shared_dir):
+    # region coordinates are saved as memory-mappable arrays, chromosomes are replaced by integer codes
+    # and names by row positions
+    chrom_codes, chroms = pd.factorize(regions_df[region + '_chrom'])
+    np.save(os.path.join(shared_dir, '{}_chrom.npy'.format(region)), chrom_codes)
+    np.save(os.path.join(shared_dir, '{}_start.npy'.format(region)), regions_df[region + '_start'].values)
+    np.save(os.path.join(shared_dir, '{}_end.npy'.format(region)), regions_df[region + '_end'].values)
+    np.save(os.path.join(shared_dir, '{}_name.npy'.format(region)), np.arange(len(regions_df)))
+    with open(os.path.join(shared_dir, '{}_chroms.json'.format(region)), 'w') as chroms_file:
+        json.dump(chroms.tolist(), chroms_file)
+
+def share_generators(generators, shared_dir):
+    # dataframes and in-memory stores become on-disk signal stores, which workers memory-map instead of unpickling
+    shared_generators = []
+    for i, (generator, dataset) in enumerate(generators):
+        store_dir = os.path.join(shared_dir, 'dataset{}.store'.format(i))
+        if isinstance(dataset, pd.DataFrame):
+            dataset = chromatics.build_signal_store(dataset, store_dir)
+        elif isinstance(dataset, chromatics.SignalStore) and dataset.store_dir is None:
+            dataset = chromatics.save_signal_store(dataset, store_dir)
+        shared_generators.append((generator, dataset))
+    return shared_generators
+
+def load_shared_chunk(shared_dir, region, chunk_lower_bound, chunk_upper_bound):
+    with open(os.path.join(shared_dir, '{}_chroms.json'.format(region))) as chroms_file:
+        chroms = np.array(json.load(chroms_file), dtype = object)
+
+    chunk_df = pd.DataFrame()
+    for column in chromatics.generic_bed_columns:
+        values = np.load(os.path.join(shared_dir, '{}_{}.npy'.format(region, column)), mmap_mode = 'r')
+        chunk_df['{}_{}'.format(region, column)] = np.array(values[chunk_lower_bound:chunk_upper_bound])
+    chunk_df[region + '_chrom'] = chroms[chunk_df[region + '_chrom'].values]
+    return chunk_df
+
+def generate_shared_chunk_features(shared_dir, region, generators, chunk_lower_bound, chunk_upper_bound):
+    # workers receive only chunk bounds and attach to the shared arrays, features are indexed by row position
+    with chromatics.time_event('chunk', region = region, chunk_lower_bound = chunk_lower_bound) as fields:
+        chunk_df = load_shared_chunk(shared_dir, region, chunk_lower_bound, chunk_upper_bound)
+        assert len(chunk_df) > 0
+        fields['rows'] = len(chunk_df)
+        return apply_generators(chunk_df, region, generators)
+
+def generate_region_features(regions_df, region, generators, chunk_size, parallel, shared_dir = None):
+    # features for each unique region, computed in chunks of unique regions rather than pairs
+    # regions should be in genomic order (get_sorted_regions) so chunks stay within one chromosome
+    chunk_bounds = get_chunk_bounds(regions_df, region, chunk_size)
+    if shared_dir is None:
+        split = split_generators(generators)
+        chroms = np.asarray(regions_df[region + '_chrom']).astype(str)
+        results = parallel(
+            joblib.delayed(generate_chunk_features)(regions_df.iloc[chunk_lower_bound:chunk_upper_bound], region, get_chrom_generators(split, chroms[chunk_lower_bound]), chunk_number, len(chunk_bounds))
+            for chunk_number, (chunk_lower_bound, chunk_upper_bound) in enumerate(chunk_bounds))
+        return pd.concat(results)
 
-def generate_training(pairs_df, regions, generators, chunk_size = 2**16, n_jobs = -1):
+    share_regions(regions_df, region, shared_dir)
+    results = parallel(
+        joblib.delayed(generate_shared_chunk_features)(shared_dir, region, generators, chunk_lower_bound, chunk_upper_bound)
+        for chunk_lower_bound, chunk_upper_bound in chunk_bounds)
+    region_features_df = pd.concat(results)
+    region_features_df.index = regions_df[region + '_name'].values[region_features_df.index.values]
+    return region_features_df
+
+def generate_training(pairs_df, regions, generators, chunk_size = 2**16, n_jobs = -1, shared_memory = False):
+    # with shared_memory, region coordinates and signal datasets are written once to memory-mapped files
+    # and workers receive only chunk bounds
     for region in regions:
         region_bed_columns = {'{}_{}'.format(region, _) for _ in chromatics.generic_bed_columns}
         assert region_bed_columns.issubset(pairs_df.columns)
 
-    max_chunks = int(np.ceil(len(pairs_df) / chunk_size))
-    results = joblib.Parallel(n_jobs)(
-        joblib.delayed(generate_chunk_features)(pairs_df, regions, generators, chunk_size, chunk_number, max_chunks)
-        for chunk_number in range(max_chunks))
+    shared_dir = tempfile.mkdtemp(dir = '/dev/shm' if os.path.isdir('/dev/shm') else None) if shared_memory else None
+    try:
+        if shared_memory:
+            generators = share_generators(generators, shared_dir)
+
+        # each region is computed once no matter how many pairs it appears in, in genomic order,
+        # then joined back to the pairs in their original order by name
+        training_df = pairs_df
+        feature_columns = []
+        with joblib.Parallel(n_jobs) as parallel:
+            for region in regions:
+                regions_df = get_sorted_regions(pairs_df, region)
+                region_features_df = generate_region_features(regions_df, region, generators, chunk_size, parallel, shared_dir)
+                feature_columns += region_features_df.columns.tolist()
+                training_df = pd.merge(training_df, region_features_df, left_on = region + '_name', right_index = True, how = 'left')
+    finally:
+        if shared_memory:
+            shutil.rmtree(shared_dir)
 
-    features_df = pd.concat(results).fillna(0)
-    training_df = pd.merge(pairs_df, features_df, left_on = ['{}_name'.format(region) for region in regions], right_index = True)
+    training_df[feature_columns] = training_df[feature_columns].fillna(0).astype(np.float32)
     assert training_df.index.is_unique
     assert training_df.columns.is_unique
     return training_df
 
+def get_dataset_names(dataset):
+    if isinstance(dataset, chromatics.SignalStore):
+        return list(dataset.datasets)
+    elif isinstance(dataset, pd.DataFrame):
+        return sorted(dataset.iloc[:, 3].unique())
+    return sorted(chromatics.read_bed(dataset, usecols = [3]).iloc[:, 0].unique())
+
+def get_feature_columns(regions, generators):
+    # feature columns every generator can produce, known before any features are computed
+    feature_columns = []
+    for region in regions:
+        for generator, dataset in generators:
+            feature_columns += [column for _ in get_dataset_names(dataset) for column in get_generator_columns(generator, _, region)]
+    return pd.Index(feature_columns).unique().tolist()
+
+def generate_pair_chunk_features(chunk_df, regions, generators, feature_columns):
+    training_chunk_df = chunk_df
+    for region in regions:
+        regions_df = get_unique_regions(chunk_df, region)
+        with chromatics.time_event('chunk', region = region, pair_offset = int(chunk_df.index[0]), rows = len(regions_df)):
+            region_features_df = apply_generators(regions_df, region, generators)
+        training_chunk_df = pd.merge(training_chunk_df, region_features_df, left_on = region + '_name', right_index = True, how = 'left')
+    training_chunk_df.index = chunk_df.index
+
+    assert set(training_chunk_df.columns).issubset(set(chunk_df.columns) | set(feature_columns))
+    training_chunk_df = training_chunk_df.reindex(columns = chunk_df.columns.tolist() + feature_columns)
+    training_chunk_df[feature_columns] = training_chunk_df[feature_columns].fillna(0).astype(np.float32)
+    return training_chunk_df
+
+def write_training(pairs_df, regions, generators, training_fn, key = 'training', chunk_size = 2**16, n_jobs = -1, shared_memory = False, complevel = 1, complib = 'zlib', names = None):
+    # streaming alternative to generate_training: each chunk of pairs is appended to an HDF5 table as soon as
+    # its features are ready, so the full feature matrix is never resident
+    # regions are deduplicated within each chunk rather than across the whole pair set
+    # pairs in the compact schema are rendered chunk by chunk using their names lookup table
+    for region in regions:
+        region_bed_columns = {'{}_{}'.format(region, _) for _ in chromatics.generic_bed_columns}
+        assert region_bed_columns.issubset(pairs_df.columns)
+
+    # fix the table schema up front: features from dataset names, string widths from the longest value
+    feature_columns = get_feature_columns(regions, generators)
+    min_itemsize = chromatics.get_min_itemsize(pairs_df, names)
+
+    chunk_lower_bounds = list(range(0, len(pairs_df), chunk_size))
+    batch_size = n_jobs if n_jobs > 0 else max(joblib.cpu_count() + 1 + n_jobs, 1)
+
+    shared_dir = tempfile.mkdtemp(dir = '/dev/shm' if os.path.isdir('/dev/shm') else None) if shared_memory else None
+    try:
+        if shared_memory:
+            generators = share_generators(generators, shared_dir)
+
+        with pd.HDFStore(training_fn, mode = 'w', complevel = complevel, complib = complib) as store, joblib.Parallel(n_jobs) as parallel:
+            for batch_lower_bound in range(0, len(chunk_lower_bounds), batch_size):
+                print(batch_lower_bound, len(chunk_lower_bounds) - 1)
+                results = parallel(
+                    joblib.delayed(generate_pair_chunk_features)(pairs_df.iloc[chunk_lower_bound:chunk_lower_bound + chunk_size], regions, generators, feature_columns)
+                    for chunk_lower_bound in chunk_lower_bounds[batch_lower_bound:batch_lower_bound + batch_size])
+                for training_chunk_df in results:
+                    if names is not None:
+                        training_chunk_df = chromatics.render_names(training_chunk_df, names)
+                    store.append(key, training_chunk_df, format = 'table', min_itemsize = min_itemsize, index = False)
+    finally:
+        if shared_memory:
+            shutil.rmtree(shared_dir)
+
+def get_added_keys(store, key):
+    # keys of feature columns added by add_training_datasets, in the order they were added
+    prefix = '/{}_added'.format(key)
+    return sorted([_ for _ in store.keys() if _.startswith(prefix)], key = lambda _: int(_[len(prefix):]))
+
+def read_training(training_fn, key = 'training'):
+    # training table joined with any feature columns added later
+    with pd.HDFStore(training_fn, mode = 'r') as store:
+        training_df = store.select(key)
+        for added_key in get_added_keys(store, key):
+            added_df = store.select(added_key)
+            assert added_df.index.equals(training_df.index)
+            training_df = pd.concat([training_df, added_df], axis = 1)
+    return training_df
+
+def get_training_columns(training_fn, key = 'training'):
+    with pd.HDFStore(training_fn, mode = 'r') as store:
+        return [column for _ in [key] + get_added_keys(store, key) for column in store.select(_, start = 0, stop = 0).columns]
+
+def select_datasets(dataset, datasets):
+    if isinstance(dataset, chromatics.SignalStore):
+        return dataset.select_datasets(datasets)
+    signal_df = chromatics.read_signal_bed(dataset)
+    return signal_df[signal_df['dataset'].isin(datasets)].reset_index(drop = True)
+
+def has_training_pairs(pairs_df, training_fn, key = 'training', names = None):
+    # whether a training table was generated for the same pairs in the same order, by name
+    # pairs in the compact schema are compared once rendered using their names lookup table
+    name_columns = [_ for _ in pairs_df.columns if chromatics.is_name_column(_)]
+    with pd.HDFStore(training_fn, mode = 'r') as store:
+        # only tables, as written by write_training, can be read by column
+        stored_df = store.select(key, columns = name_columns) if store.get_storer(key).is_table else store.select(key)
+    if not set(name_columns).issubset(stored_df.columns) or len(stored_df) != len(pairs_df):
+        return False
+    pairs_df = pairs_df[name_columns] if names is None else chromatics.render_names(pairs_df[name_columns], names)
+    return all(np.array_equal(stored_df[_].values.astype(str), pairs_df[_].values.astype(str)) for _ in name_columns)
+
+def add_training_datasets(pairs_df, regions, generators, training_fn, key = 'training', chunk_size = 2**16, n_jobs = -1, shared_memory = False, complevel = 1, complib = 'zlib', names = None):
+    # features for dataset names missing from an existing training table, for the same pairs in the same order
+    # they are stored under a new key rather than rewriting the table, read_training joins them back
+    if not has_training_pairs(pairs_df, training_fn, key, names):
+        raise Exception('Pairs differ from those in {}'.format(training_fn))
+    existing_columns = set(get_training_columns(training_fn, key))
+    missing_generators = []
+    for generator, dataset in generators:
+        missing_datasets = [_ for _ in get_dataset_names(dataset) if any(column not in existing_columns for region in regions for column in get_generator_columns(generator, _, region))]
+        if len(missing_datasets) > 0:
+            missing_generators.append((generator, select_datasets(dataset, missing_datasets)))
+    if len(missing_generators) == 0:
+        return []
+
+    feature_columns = [_ for _ in get_feature_columns(regions, missing_generators) if _ not in existing_columns]
+    training_df = generate_training(pairs_df, regions, missing_generators, chunk_size, n_jobs, shared_memory)
+    added_df = training_df.reindex(columns = feature_columns).fillna(0).astype(np.float32)
+
+    with pd.HDFStore(training_fn, mode = 'a', complevel = complevel, complib = complib) as store:
+        store.put('{}_added{}'.format(key, len(get_added_keys(store, key))), added_df)
+    return feature_columns
+
 def get_random_pairs(pair_count, region_a_prefix = 'r1', region_b_prefix = 'r2', random_state = 0):
     random_state = np.random.RandomState(random_state)
     f1_start = random_state.randint(0, 1e6, pair_count)
@@ -75,6 +381,68 @@ def test_generate_average_signal_features():
     assert average_signal_df.loc['enhancer1', 'CTCF (enhancer)'] == 0.502
     print(average_signal_df)
 
+    store_average_signal_df = generate_average_signal_features(enhancers_df, 'enhancer', chromatics.get_signal_store('peaks.bed'))
+    assert store_average_signal_df.equals(average_signal_df)
+
+def test_generate_prefix_sum_signal_features():
+    enhancers_df = chromatics.read_bed('enhancers.bed', names = chromatics.enhancer_bed_columns)
+    average_signal_df = generate_prefix_sum_signal_features(enhancers_df, 'enhancer', 'peaks.bed')
+    assert np.isclose(average_signal_df.loc['enhancer1', 'RAD21 (enhancer)'], 2.1)
+    assert np.isclose(average_signal_df.loc['enhancer1', 'CTCF (enhancer)'], 0.502)
+    print(average_signal_df)
+
+    pairs_df = get_random_pairs(1000, 'enhancer', 'promoter')
+    signal_df = chromatics.read_bed('wgEncodeAwgDnaseUwdukeK562UniPk.narrowPeak.gz', names = chromatics.narrowpeak_bed_columns, usecols = ['chrom', 'start', 'end', 'signal_value'])
+    signal_df['dataset'] = 'DNase'
+    store = chromatics.get_signal_store(signal_df[chromatics.signal_bed_columns])
+    expected_df = generate_average_signal_features(pairs_df, 'promoter', store)
+    prefix_sum_df = generate_prefix_sum_signal_features(pairs_df, 'promoter', store)
+    assert expected_df.index.equals(prefix_sum_df.index) and expected_df.columns.equals(prefix_sum_df.columns)
+    assert np.allclose(expected_df.values, prefix_sum_df.values)
+
+def test_generate_flank_signal_features():
+    pairs_df = get_random_pairs(1000, 'enhancer', 'promoter')
+    signal_df = chromatics.read_bed('wgEncodeAwgDnaseUwdukeK562UniPk.narrowPeak.gz', names = chromatics.narrowpeak_bed_columns, usecols = ['chrom', 'start', 'end', 'signal_value'])
+    signal_df['dataset'] = 'DNase'
+    store = chromatics.get_signal_store(signal_df[chromatics.signal_bed_columns])
+    flank_df = generate_flank_signal_features(pairs_df, 'enhancer', store, [500, 3000])
+    assert flank_df.columns.tolist() == ['DNase (enhancer)', 'DNase (enhancer±3kb)', 'DNase (enhancer±500bp)']
+
+    # each scale matches prefix sum features of regions extended like enhancer_extension_size
+    for flank_size, column in [(0, 'DNase (enhancer)'), (500, 'DNase (enhancer±500bp)'), (3000, 'DNase (enhancer±3kb)')]:
+        extended_df = pairs_df.copy()
+        extended_df['enhancer_start'] -= flank_size
+        extended_df['enhancer_end'] += flank_size
+        expected = generate_prefix_sum_signal_features(extended_df, 'enhancer', store)['DNase (enhancer)']
+        assert np.allclose(flank_df[column].dropna().sort_index().values, expected.values)
+        assert flank_df[column].dropna().index.equals(expected.index)
+
+    generators = [(functools.partial(generate_flank_signal_features, flank_sizes = [3000]), signal_df[chromatics.signal_bed_columns])]
+    feature_columns = get_feature_columns(['enhancer', 'promoter'], generators)
+    assert feature_columns == ['DNase (enhancer)', 'DNase (enhancer±3kb)', 'DNase (promoter)', 'DNase (promoter±3kb)']
+    training_df = generate_training(pairs_df, ['enhancer', 'promoter'], generators, chunk_size = 256, n_jobs = 2, shared_memory = True)
+    assert training_df.columns[len(pairs_df.columns):].tolist() == feature_columns
+    assert np.allclose(training_df['DNase (enhancer±3kb)'].values, flank_df['DNase (enhancer±3kb)'].reindex(pairs_df['enhancer_name']).fillna(0).values)
+
+def test_get_chunk_bounds():
+    pairs_df = get_random_pairs(1000, 'enhancer', 'promoter')
+    regions_df = get_sorted_regions(pairs_df, 'enhancer')
+    chunk_bounds = get_chunk_bounds(regions_df, 'enhancer', 16)
+    assert chunk_bounds[0][0] == 0 and chunk_bounds[-1][1] == len(regions_df)
+    assert all(upper_bound == lower_bound for (_, upper_bound), (lower_bound, _) in zip(chunk_bounds[:-1], chunk_bounds[1:]))
+    assert all(0 < upper_bound - lower_bound <= 16 and regions_df['enhancer_chrom'].iloc[lower_bound:upper_bound].nunique() == 1 for lower_bound, upper_bound in chunk_bounds)
+
+    # features come back in the original pair order whatever the chunking, also for datasets missing chromosomes
+    signal_df = chromatics.read_bed('wgEncodeAwgDnaseUwdukeK562UniPk.narrowPeak.gz', names = chromatics.narrowpeak_bed_columns, usecols = ['chrom', 'start', 'end', 'signal_value'])
+    signal_df['dataset'] = 'DNase'
+    signal_df = signal_df[signal_df['chrom'] != 'chr2'][chromatics.signal_bed_columns]
+    generators = [(generate_prefix_sum_signal_features, signal_df)]
+    training_df = generate_training(pairs_df, ['enhancer', 'promoter'], generators, chunk_size = 16, n_jobs = 2)
+    shared_training_df = generate_training(pairs_df, ['enhancer', 'promoter'], generators, chunk_size = 2**16, n_jobs = 1, shared_memory = True)
+    assert training_df.index.equals(pairs_df.index) and training_df[pairs_df.columns].equals(pairs_df)
+    assert training_df.equals(shared_training_df)
+    assert (training_df.loc[pairs_df['enhancer_chrom'] == 'chr2', 'DNase (enhancer)'] == 0).all()
+
 def test_generate_training():
     regions = ['enhancer', 'promoter']
     pairs_df = get_random_pairs(100, regions[0], regions[1])
@@ -87,6 +455,84 @@ def test_generate_training():
     training_df = generate_training(pairs_df, regions, generators, chunk_size = len(pairs_df) // 2)
     print(training_df.head(), '\n')
 
+    shared_training_df = generate_training(pairs_df, regions, generators, chunk_size = len(pairs_df) // 2, shared_memory = True)
+    feature_columns = training_df.columns[len(pairs_df.columns):]
+    assert set(shared_training_df.columns) == set(training_df.columns)
+    assert np.allclose(shared_training_df[feature_columns].values, training_df[feature_columns].values)
+
+def test_write_training():
+    regions = ['enhancer', 'promoter']
+    pairs_df = get_random_pairs(100, regions[0], regions[1])
+    # strings in later chunks are wider than in the first, as with distance bin labels read from pairs.csv
+    pairs_df['bin'] = pd.Series(['(0, 1]'] * 50 + ['(100000, 2000000]'] * 50, dtype = 'str')
+    pairs_df.loc[99, 'promoter_name'] = 'promoter_with_a_much_longer_name'
+
+    signal_df = chromatics.read_bed('wgEncodeAwgDnaseUwdukeK562UniPk.narrowPeak.gz', names = chromatics.narrowpeak_bed_columns, usecols = ['chrom', 'start', 'end', 'signal_value'])
+    signal_df['dataset'] = 'DNase'
+    signal_df = signal_df[chromatics.signal_bed_columns]
+    generators = [(generate_prefix_sum_signal_features, signal_df)]
+    training_df = generate_training(pairs_df, regions, generators, chunk_size = len(pairs_df) // 2)
+
+    training_fd, training_fn = tempfile.mkstemp(suffix = '.h5')
+    write_training(pairs_df, regions, generators, training_fn, chunk_size = len(pairs_df) // 3)
+    streamed_training_df = read_training(training_fn)
+    os.close(training_fd)
+    os.remove(training_fn)
+
+    assert streamed_training_df.columns.tolist() == training_df.columns.tolist()
+    assert streamed_training_df[pairs_df.columns].astype(object).equals(training_df[pairs_df.columns].astype(object))
+    assert np.allclose(streamed_training_df.values[:, len(pairs_df.columns):].astype(float), training_df.values[:, len(pairs_df.columns):].astype(float))
+
+    # pairs in the compact schema are written with their rendered names
+    compact_df, names = chromatics.compact_pairs(pairs_df)
+    training_fd, training_fn = tempfile.mkstemp(suffix = '.h5')
+    write_training(compact_df, regions, generators, training_fn, chunk_size = len(pairs_df) // 3, names = names)
+    streamed_training_df = read_training(training_fn)
+    os.close(training_fd)
+    os.remove(training_fn)
+
+    assert streamed_training_df[pairs_df.columns].astype(object).equals(training_df[pairs_df.columns].astype(object))
+    assert np.allclose(streamed_training_df.values[:, len(pairs_df.columns):].astype(float), training_df.values[:, len(pairs_df.columns):].astype(float))
+
+def test_add_training_datasets():
+    regions = ['enhancer', 'promoter']
+    pairs_df = get_random_pairs(100, regions[0], regions[1])
+
+    signal_df = chromatics.read_bed('wgEncodeAwgDnaseUwdukeK562UniPk.narrowPeak.gz', names = chromatics.narrowpeak_bed_columns, usecols = ['chrom', 'start', 'end', 'signal_value'])
+    signal_df['dataset'] = 'DNase'
+    shifted_signal_df = signal_df.copy()
+    shifted_signal_df['start'] += 1000
+    shifted_signal_df['end'] += 1000
+    shifted_signal_df['dataset'] = 'Shifted'
+    signal_df = pd.concat([signal_df, shifted_signal_df], ignore_index = True)[chromatics.signal_bed_columns]
+    store = chromatics.get_signal_store(signal_df)
+    expected_df = generate_training(pairs_df, regions, [(generate_prefix_sum_signal_features, store)])
+
+    training_fd, training_fn = tempfile.mkstemp(suffix = '.h5')
+    generate_training(pairs_df, regions, [(generate_prefix_sum_signal_features, store.select_datasets(['DNase']))]).to_hdf(training_fn, key = 'training', mode = 'w')
+    added_columns = add_training_datasets(pairs_df, regions, [(generate_prefix_sum_signal_features, store)], training_fn)
+    assert added_columns == ['Shifted (enhancer)', 'Shifted (promoter)']
+    assert add_training_datasets(pairs_df, regions, [(generate_prefix_sum_signal_features, store)], training_fn) == []
+
+    # features are never added next to rows for other pairs
+    assert not has_training_pairs(pairs_df.iloc[::-1], training_fn)
+    try:
+        add_training_datasets(pairs_df.iloc[::-1], regions, [(generate_prefix_sum_signal_features, store)], training_fn)
+        assert False
+    except Exception as e:
+        assert str(e).startswith('Pairs differ')
+    training_df = read_training(training_fn)
+    os.close(training_fd)
+    os.remove(training_fn)
+
+    assert set(training_df.columns) == set(expected_df.columns)
+    assert np.allclose(training_df[expected_df.columns[len(pairs_df.columns):]].values, expected_df.iloc[:, len(pairs_df.columns):].values)
+
 if __name__ == '__main__':
     test_generate_average_signal_features()
+    test_generate_prefix_sum_signal_features()
+    test_generate_flank_signal_features()
+    test_get_chunk_bounds()
     test_generate_training()
+    test_write_training()
+    test_add_training_datasets()
@@ -0,0 +1,117 @@
+import atexit
+import chromatics
+import contextlib
+import cProfile
+import json
+import os
+import pandas as pd
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# timing and memory events appended as json lines to the file named by CHROMATICS_EVENTS, and cProfile dumps
+# of whole scripts written to CHROMATICS_PROFILE_DIR, both disabled when unset
+# settings live in the environment so joblib workers and pipeline scripts inherit them, and events from
+# workers carry the name of the script that started them
+# peak rss is per process and only grows, so it bounds rather than measures the memory of a step
+
+events_variable = 'CHROMATICS_EVENTS'
+profile_variable = 'CHROMATICS_PROFILE_DIR'
+script_variable = 'CHROMATICS_SCRIPT'
+
+def configure_instrumentation(events_fn = None, profile_dir = None):
+    # paths are made absolute since scripts change directory after starting
+    for variable, path in [(events_variable, events_fn), (profile_variable, profile_dir)]:
+        if path is None:
+            os.environ.pop(variable, None)
+        else:
+            os.environ[variable] = os.path.abspath(path)
+
+# relative paths in the environment are resolved against the directory chromatics is imported from
+configure_instrumentation(os.environ.get(events_variable), os.environ.get(profile_variable))
+
+def get_peak_rss():
+    # in MB, ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+def record_event(event, **fields):
+    events_fn = os.environ.get(events_variable)
+    if events_fn is None:
+        return
+    record = {'event': event, 'time': time.time(), 'pid': os.getpid(), 'script': os.environ.get(script_variable), 'peak_rss_mb': get_peak_rss()}
+    record.update(fields)
+    # one write per line keeps lines from concurrent processes whole
+    with open(events_fn, 'a') as events_file:
+        events_file.write(json.dumps(record, default = str) + '\n')
+
+@contextlib.contextmanager
+def time_event(event, **fields):
+    # fields added to the yielded dict, e.g. byte counts, are recorded along with the wall time
+    if events_variable not in os.environ:
+        yield {}
+        return
+    start_time = time.perf_counter()
+    yield fields
+    record_event(event, seconds = time.perf_counter() - start_time, **fields)
+
+def instrument_script(name = None):
+    # one line at the top of a script, records its start and end and optionally profiles the main process
+    name = name or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    os.environ[script_variable] = name
+    record_event('script_start', argv = sys.argv[1:])
+    start_time = time.perf_counter()
+
+    profile_dir = os.environ.get(profile_variable)
+    profile = None
+    if profile_dir is not None:
+        profile = cProfile.Profile()
+        profile.enable()
+
+    def finish():
+        if profile is not None:
+            profile.disable()
+            os.makedirs(profile_dir, exist_ok = True)
+            profile.dump_stats(os.path.join(profile_dir, '{}-{}.prof'.format(name, os.getpid())))
+        record_event('script_end', seconds = time.perf_counter() - start_time)
+    atexit.register(finish)
+
+def read_events(events_fn):
+    return pd.read_json(events_fn, lines = True)
+
+def test_record_event():
+    temp_dir = tempfile.mkdtemp()
+    events_fn = os.path.join(temp_dir, 'events.jsonl')
+    try:
+        with time_event('disabled') as fields:
+            fields['ignored'] = 1
+        assert not os.path.exists(events_fn)
+
+        configure_instrumentation(events_fn)
+        pairs_df = chromatics.get_random_pairs(20, 'enhancer', 'promoter')
+        signal_df = pairs_df[chromatics.enhancer_bed_columns[:3]].copy()
+        signal_df.columns = chromatics.signal_bed_columns[:3]
+        signal_df['dataset'] = 'DNase'
+        signal_df['signal_value'] = 1.0
+        generators = [(chromatics.generate_prefix_sum_signal_features, signal_df)]
+        chromatics.generate_training(pairs_df, ['enhancer', 'promoter'], generators, chunk_size = 8, n_jobs = 1)
+        chromatics.bedtools('intersect -u', pairs_df[chromatics.enhancer_bed_columns], signal_df, engine = 'native')
+
+        events_df = read_events(events_fn)
+        print(events_df)
+        counts = events_df['event'].value_counts()
+        assert counts['bedtools'] == 1 and 0 < counts['generator'] <= counts['chunk']
+        assert (events_df['seconds'] >= 0).all() and (events_df['peak_rss_mb'] > 0).all()
+
+        # every region of both types is in exactly one chunk
+        chunk_events_df = events_df.query('event == "chunk"')
+        assert chunk_events_df['rows'].sum() == 2 * 20 and chunk_events_df['rows'].max() <= 8
+        generator_events_df = events_df.query('event == "generator"')
+        assert (generator_events_df['generator'] == 'generate_prefix_sum_signal_features').all()
+    finally:
+        configure_instrumentation()
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    test_record_event()
@@ -2,10 +2,11 @@ import chromatics
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
+import sklearn.externals.joblib as joblib
 
-def get_enrichment(a, b, c):
-    a_with_c = chromatics.bedtools('intersect -sorted -u -f 1.0', a, c)
-    b_with_c = chromatics.bedtools('intersect -sorted -u -f 1.0', b, c)
+def get_enrichment(a, b, c, engine = 'subprocess'):
+    a_with_c = chromatics.bedtools('intersect -sorted -u -f 1.0', a, c, engine = engine)
+    b_with_c = chromatics.bedtools('intersect -sorted -u -f 1.0', b, c, engine = engine)
 
     ct = np.zeros([2, 2])
     ct[0, 0] = len(b) - len(b_with_c)
@@ -15,6 +16,68 @@ def get_enrichment(a, b, c):
 
     return stats.fisher_exact(ct)[1]
 
+def get_fdr(p_values):
+    # benjamini-hochberg adjusted p-values
+    p_values = np.asarray(p_values, dtype = float)
+    order = np.argsort(p_values, kind = 'mergesort')
+    ranked = p_values[order] * len(p_values) / np.arange(1, len(p_values) + 1)
+    fdr = np.empty_like(ranked)
+    fdr[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return fdr
+
+def get_permuted_hits(hit_elements, hit_tracks, element_count, a_count, track_count, permutations, seed):
+    # hits per track among a random a-sized subset of elements, one row per permutation
+    random_state = np.random.RandomState(seed)
+    permuted_hits = np.zeros((permutations, track_count), dtype = np.int64)
+    for permutation in range(permutations):
+        in_a = np.zeros(element_count, dtype = bool)
+        in_a[random_state.choice(element_count, a_count, replace = False)] = True
+        permuted_hits[permutation] = np.bincount(hit_tracks[in_a[hit_elements]], minlength = track_count)
+    return permuted_hits
+
+def get_enrichments(a, b, tracks, permutations = 0, n_jobs = 1, random_state = 0, batch_size = 100):
+    # get_enrichment for many tracks (name: bed-like frame) from a single overlap sweep of a and b against all of them
+    # the optional permutation null reassigns elements to a and b at random, reusing the same overlaps,
+    # with batches seeded by position so results do not depend on n_jobs
+    elements_df, element_sets, _ = stack_tracks([a, b])
+    track_names = list(tracks)
+    tracks_df, interval_tracks, _ = stack_tracks([tracks[_] for _ in track_names])
+    element_indices, interval_indices = chromatics.get_overlap_pairs(elements_df, tracks_df, left_fraction = 1.0)
+
+    # an element hits a track once no matter how many of its intervals cover it
+    hits = np.unique(element_indices * len(track_names) + interval_tracks[interval_indices])
+    hit_elements = hits // len(track_names)
+    hit_tracks = hits % len(track_names)
+    a_with = np.bincount(hit_tracks[element_sets[hit_elements] == 0], minlength = len(track_names))
+    b_with = np.bincount(hit_tracks[element_sets[hit_elements] == 1], minlength = len(track_names))
+
+    enrichments_df = pd.DataFrame({
+        'track': track_names,
+        'a_with': a_with,
+        'a_without': len(a) - a_with,
+        'b_with': b_with,
+        'b_without': len(b) - b_with
+        }, columns = ['track', 'a_with', 'a_without', 'b_with', 'b_without'])
+    tests = [stats.fisher_exact([[row.b_without, row.b_with], [row.a_without, row.a_with]]) for row in enrichments_df.itertuples()]
+    enrichments_df['odds_ratio'] = [_[0] for _ in tests]
+    enrichments_df['p_value'] = [_[1] for _ in tests]
+    enrichments_df['fdr'] = get_fdr(enrichments_df['p_value'])
+
+    if permutations > 0:
+        batches = [(_, min(batch_size, permutations - _)) for _ in range(0, permutations, batch_size)]
+        results = joblib.Parallel(n_jobs)(
+            joblib.delayed(get_permuted_hits)(hit_elements, hit_tracks, len(elements_df), len(a), len(track_names), batch_permutations, [random_state, batch_lower_bound])
+            for batch_lower_bound, batch_permutations in batches)
+        permuted_a_with = np.concatenate(results)
+
+        # two-sided, as extreme as observed in either direction from the expected hits in a
+        expected_a_with = (a_with + b_with) * len(a) / len(elements_df)
+        extreme_counts = (np.abs(permuted_a_with - expected_a_with) >= np.abs(a_with - expected_a_with) - 1e-9).sum(axis = 0)
+        enrichments_df['permutation_p_value'] = (extreme_counts + 1) / (permutations + 1)
+        enrichments_df['permutation_fdr'] = get_fdr(enrichments_df['permutation_p_value'])
+
+    return enrichments_df
+
 def get_labeled_enhancers(enhancers_fn, pairs_fn):
     enhancers_df = chromatics.read_bed(enhancers_fn, names = chromatics.enhancer_bed_columns)
     pairs_df = pd.read_csv(pairs_fn)
@@ -57,39 +120,114 @@ def correct_fragment_order(df, left_columns, right_columns, flipped_mask):
     corrected_df[flipped_mask] = corrected_df.loc[flipped_mask, right_columns + left_columns + unaltered_columns].values
     return corrected_df
 
-def get_interaction_types(interactions_df, interaction_id_column, left_fragment_columns, right_fragment_columns, elements):
+def get_fragment_element_overlaps(interactions_df, left_fragment_columns, right_fragment_columns, elements):
+    # bool matrix of interactions x (fragment side, element track) from one overlap sweep over all tracks,
+    # rows are aligned by position with interactions_df
+    labels = sorted(elements)
+    fragments_df, fragment_sides, fragment_positions = stack_tracks([interactions_df[left_fragment_columns], interactions_df[right_fragment_columns]])
+    elements_df, element_tracks, _ = stack_tracks([elements[_] for _ in labels])
+    fragment_indices, element_indices = chromatics.get_overlap_pairs(fragments_df, elements_df)
+
+    overlaps = np.zeros((len(interactions_df), 2 * len(labels)), dtype = bool)
+    overlaps[fragment_positions[fragment_indices], fragment_sides[fragment_indices] * len(labels) + element_tracks[element_indices]] = True
+    columns = ['left_fragment_{}'.format(_) for _ in labels] + ['right_fragment_{}'.format(_) for _ in labels]
+    return pd.DataFrame(overlaps, columns = columns)
+
+def get_interaction_types(interactions_df, interaction_id_column, left_fragment_columns, right_fragment_columns, elements, engine = 'subprocess'):
     def get_fragment_elements(fragments_df, elements_df):
-        return set(chromatics.bedtools('intersect -wa -u', fragments_df, elements_df).iloc[:, -1])
+        return set(chromatics.bedtools('intersect -wa -u', fragments_df, elements_df, engine = engine).iloc[:, -1])
 
     interaction_types_df = interactions_df.copy()
+    if engine == 'sweep':
+        overlaps_df = get_fragment_element_overlaps(interactions_df, left_fragment_columns, right_fragment_columns, elements)
+        for column in overlaps_df.columns:
+            interaction_types_df[column] = overlaps_df[column].values
+        return interaction_types_df
+
     left_fragments_df = interaction_types_df[left_fragment_columns]
     right_fragments_df = interaction_types_df[right_fragment_columns]
 
     for element_label, elements_df in sorted(elements.items()):
         left_fragment_elements = get_fragment_elements(left_fragments_df, elements_df)
-        interaction_types_df.eval('left_fragment_{} = {} in @left_fragment_elements'.format(element_label, left_fragments_df.columns[-1]))
+        interaction_types_df.eval('left_fragment_{} = {} in @left_fragment_elements'.format(element_label, left_fragments_df.columns[-1]), inplace = True)
 
     for element_label, elements_df in sorted(elements.items()):
         right_fragment_elements = get_fragment_elements(right_fragments_df, elements_df)
-        interaction_types_df.eval('right_fragment_{} = {} in @right_fragment_elements'.format(element_label, right_fragments_df.columns[-1]))
+        interaction_types_df.eval('right_fragment_{} = {} in @right_fragment_elements'.format(element_label, right_fragments_df.columns[-1]), inplace = True)
 
     return interaction_types_df
 
-def get_interaction_elements(interactions_df, interaction_id_column, left_fragment_columns, right_fragment_columns, left_elements_df, right_elements_df):
+def stack_tracks(dfs):
+    # a single interval table over several bed-like frames, with the frame and row each interval came from
+    coordinates = [chromatics.get_coordinates(_) for _ in dfs]
+    stacked_df = pd.DataFrame({
+        'chrom': np.concatenate([_[0] for _ in coordinates]),
+        'start': np.concatenate([_[1] for _ in coordinates]),
+        'end': np.concatenate([_[2] for _ in coordinates])
+        })
+    tracks = np.repeat(np.arange(len(dfs)), [len(_) for _ in dfs])
+    positions = np.concatenate([np.arange(len(_)) for _ in dfs])
+    return stacked_df, tracks, positions
+
+def join_on_interactions(left_interactions, left_elements, right_interactions, right_elements):
+    # every (interaction, left element, right element) combination sharing an interaction
+    order = np.argsort(right_interactions, kind = 'mergesort')
+    right_interactions = right_interactions[order]
+    right_elements = right_elements[order]
+    owners, positions = chromatics.expand_ranges(
+        np.searchsorted(right_interactions, left_interactions, side = 'left'),
+        np.searchsorted(right_interactions, left_interactions, side = 'right'))
+    return left_interactions[owners], left_elements[owners], right_elements[positions]
+
+def get_interaction_element_indices(interactions_df, left_fragment_columns, right_fragment_columns, left_elements_df, right_elements_df):
+    # both fragment sides against both element types in one overlap sweep per chromosome
+    # returns (interaction, left element, right element) row positions, one per unique element pair
+    fragments_df, fragment_sides, fragment_interactions = stack_tracks([interactions_df[left_fragment_columns], interactions_df[right_fragment_columns]])
+    elements_df, element_types, element_positions = stack_tracks([left_elements_df, right_elements_df])
+    fragment_indices, element_indices = chromatics.get_overlap_pairs(fragments_df, elements_df)
+    sides = fragment_sides[fragment_indices]
+    types = element_types[element_indices]
+    interactions = fragment_interactions[fragment_indices]
+    elements = element_positions[element_indices]
+
+    def get_hits(side, element_type):
+        mask = (sides == side) & (types == element_type)
+        return interactions[mask], elements[mask]
+
+    # left elements on left fragments paired with right elements on right fragments, then the reverse
+    left_first = join_on_interactions(*get_hits(0, 0), *get_hits(1, 1))
+    right_first = join_on_interactions(*get_hits(1, 0), *get_hits(0, 1))
+    interaction_indices, left_indices, right_indices = [np.concatenate(_) for _ in zip(left_first, right_first)]
+
+    # keep the first interaction found for each element pair
+    _, first_indices = np.unique(left_indices * len(right_elements_df) + right_indices, return_index = True)
+    first_indices.sort()
+    return interaction_indices[first_indices], left_indices[first_indices], right_indices[first_indices]
+
+def get_interaction_elements(interactions_df, interaction_id_column, left_fragment_columns, right_fragment_columns, left_elements_df, right_elements_df, engine = 'subprocess'):
     left_element_name_column = left_elements_df.columns[-1]
     right_element_name_column = right_elements_df.columns[-1]
     assert left_element_name_column.endswith('_name') and right_element_name_column.endswith('_name')
 
+    if engine == 'sweep':
+        interaction_indices, left_indices, right_indices = get_interaction_element_indices(interactions_df, left_fragment_columns, right_fragment_columns, left_elements_df, right_elements_df)
+        return pd.concat([
+            left_elements_df.iloc[left_indices].reset_index(drop = True),
+            interactions_df[left_fragment_columns + [interaction_id_column]].iloc[interaction_indices].reset_index(drop = True),
+            right_elements_df.iloc[right_indices].reset_index(drop = True),
+            interactions_df[right_fragment_columns].iloc[interaction_indices].reset_index(drop = True)
+            ], axis = 1)
+
     # include interaction ids for re-merging pairs
     left_fragments_df = interactions_df[left_fragment_columns + [interaction_id_column]]
     right_fragments_df = interactions_df[right_fragment_columns + [interaction_id_column]]
 
-    left_elements_left_fragments_df = chromatics.bedtools('intersect -wa -wb', left_elements_df, left_fragments_df)
-    right_elements_right_fragments_df = chromatics.bedtools('intersect -wa -wb', right_elements_df, right_fragments_df)
+    left_elements_left_fragments_df = chromatics.bedtools('intersect -wa -wb', left_elements_df, left_fragments_df, engine = engine)
+    right_elements_right_fragments_df = chromatics.bedtools('intersect -wa -wb', right_elements_df, right_fragments_df, engine = engine)
     left_first_pairs_df = pd.merge(left_elements_left_fragments_df, right_elements_right_fragments_df, on = interaction_id_column)
 
-    right_elements_left_fragments_df = chromatics.bedtools('intersect -wa -wb', right_elements_df, left_fragments_df)
-    left_elements_right_fragments_df = chromatics.bedtools('intersect -wa -wb', left_elements_df, right_fragments_df)
+    right_elements_left_fragments_df = chromatics.bedtools('intersect -wa -wb', right_elements_df, left_fragments_df, engine = engine)
+    left_elements_right_fragments_df = chromatics.bedtools('intersect -wa -wb', left_elements_df, right_fragments_df, engine = engine)
     right_first_pairs_df = pd.merge(right_elements_left_fragments_df, left_elements_right_fragments_df, on = interaction_id_column)
 
     interaction_elements_df = pd.concat([left_first_pairs_df, right_first_pairs_df], ignore_index = True)
@@ -136,6 +274,23 @@ def test_get_interaction_types():
         )
     print(typed_interactions_df)
 
+def test_get_fragment_element_overlaps():
+    left_fragment_bed_columns = ['f1_' + _ for _ in chromatics.generic_bed_columns]
+    right_fragment_bed_columns = ['f2_' + _ for _ in chromatics.generic_bed_columns]
+    interactions_df = chromatics.get_random_pairs(500, 'f1', 'f2', random_state = 1)
+    elements_df = chromatics.get_random_pairs(1000, 'enhancer', 'promoter', random_state = 2)
+    elements = {
+        'enhancer': elements_df[chromatics.enhancer_bed_columns],
+        'promoter': elements_df[chromatics.promoter_bed_columns],
+        'ctcf': chromatics.read_bed('wgEncodeAwgDnaseUwdukeK562UniPk.narrowPeak.gz', names = chromatics.narrowpeak_bed_columns, usecols = chromatics.generic_bed_columns)
+        }
+
+    native_df = get_interaction_types(interactions_df, 'interaction_id', left_fragment_bed_columns, right_fragment_bed_columns, elements, engine = 'native')
+    swept_df = get_interaction_types(interactions_df, 'interaction_id', left_fragment_bed_columns, right_fragment_bed_columns, elements, engine = 'sweep')
+    assert swept_df.columns.tolist() == native_df.columns.tolist()
+    assert swept_df.equals(native_df)
+    assert swept_df['left_fragment_enhancer'].any() and swept_df['right_fragment_ctcf'].any()
+
 def test_get_interaction_elements():
     left_fragment_bed_columns = ['f1_' + _ for _ in chromatics.generic_bed_columns]
     right_fragment_bed_columns = ['f2_' + _ for _ in chromatics.generic_bed_columns]
@@ -157,7 +312,79 @@ def test_get_interaction_elements():
     print(interaction_elements_df)
     assert set(interaction_elements_df['interaction_id']) == {'chr1:250-350.chr1:5000-5050', 'chr1:2000-3000.chr1:210-290'}
 
+    swept_df = get_interaction_elements(interactions_df, 'interaction_id', left_fragment_bed_columns, right_fragment_bed_columns, enhancers_df, promoters_df, engine = 'sweep')
+    assert swept_df.columns.tolist() == interaction_elements_df.columns.tolist()
+    assert set(swept_df['interaction_id']) == set(interaction_elements_df['interaction_id'])
+
+def test_get_swept_interaction_elements():
+    # the sweep matches the bedtools-based path, here without needing the bedtools binary
+    left_fragment_bed_columns = ['f1_' + _ for _ in chromatics.generic_bed_columns]
+    right_fragment_bed_columns = ['f2_' + _ for _ in chromatics.generic_bed_columns]
+    enhancers_df = chromatics.read_bed('enhancers.bed', names = chromatics.enhancer_bed_columns)
+    promoters_df = chromatics.read_bed('promoters.bed', names = chromatics.promoter_bed_columns)
+    interactions_df = chromatics.read_bed('interactions.bed', names = left_fragment_bed_columns + ['interaction_id'] + right_fragment_bed_columns)
+
+    native_df = get_interaction_elements(interactions_df, 'interaction_id', left_fragment_bed_columns, right_fragment_bed_columns, enhancers_df, promoters_df, engine = 'native')
+    swept_df = get_interaction_elements(interactions_df, 'interaction_id', left_fragment_bed_columns, right_fragment_bed_columns, enhancers_df, promoters_df, engine = 'sweep')
+    print(swept_df)
+    assert swept_df.columns.tolist() == native_df.columns.tolist()
+    assert len(swept_df) == len(native_df) == 2
+
+    # one row per (enhancer, promoter) pair, with the same fragments and interaction
+    pair_columns = ['enhancer_name', 'promoter_name']
+    assert not swept_df.duplicated(pair_columns).any()
+    native_df = native_df.sort_values(pair_columns).reset_index(drop = True)
+    swept_df = swept_df.sort_values(pair_columns).reset_index(drop = True)
+    for column in pair_columns + ['interaction_id'] + left_fragment_bed_columns + right_fragment_bed_columns:
+        assert swept_df[column].tolist() == native_df[column].tolist()
+
+def test_get_interaction_element_indices():
+    left_fragment_bed_columns = ['f1_' + _ for _ in chromatics.generic_bed_columns]
+    right_fragment_bed_columns = ['f2_' + _ for _ in chromatics.generic_bed_columns]
+    interactions_df = chromatics.get_random_pairs(500, 'f1', 'f2', random_state = 1)
+    interactions_df['interaction_id'] = interactions_df['f1_name'] + '.' + interactions_df['f2_name']
+    enhancers_df = chromatics.get_random_pairs(2000, 'enhancer', 'promoter', random_state = 2)
+    promoters_df = enhancers_df[chromatics.promoter_bed_columns]
+    enhancers_df = enhancers_df[chromatics.enhancer_bed_columns]
+
+    native_df = get_interaction_elements(interactions_df, 'interaction_id', left_fragment_bed_columns, right_fragment_bed_columns, enhancers_df, promoters_df, engine = 'native')
+    interaction_indices, enhancer_indices, promoter_indices = get_interaction_element_indices(interactions_df, left_fragment_bed_columns, right_fragment_bed_columns, enhancers_df, promoters_df)
+    assert len(native_df) > 0
+    assert set(zip(native_df['enhancer_name'], native_df['promoter_name'])) == \
+        set(zip(enhancers_df['enhancer_name'].values[enhancer_indices], promoters_df['promoter_name'].values[promoter_indices]))
+
+def test_get_enrichments():
+    elements_df = chromatics.get_random_pairs(2000, 'enhancer', 'promoter', random_state = 3)[chromatics.enhancer_bed_columns]
+    elements_df['enhancer_end'] = elements_df['enhancer_start'] + 50
+    a = elements_df.iloc[:500]
+    b = elements_df.iloc[500:]
+    peaks_df = chromatics.read_bed('wgEncodeAwgDnaseUwdukeK562UniPk.narrowPeak.gz', names = chromatics.narrowpeak_bed_columns, usecols = chromatics.generic_bed_columns)
+    covering_df = a.iloc[::2].copy()
+    covering_df.iloc[:, 1] -= 10
+    tracks = {'peaks{}'.format(i): peaks_df.iloc[i::3] for i in range(3)}
+    tracks['covering'] = covering_df
+    tracks['empty'] = peaks_df.iloc[:0]
+
+    enrichments_df = get_enrichments(a, b, tracks, permutations = 200, n_jobs = 2)
+    print(enrichments_df)
+    assert enrichments_df['track'].tolist() == list(tracks)
+    for track, p_value in zip(enrichments_df['track'], enrichments_df['p_value']):
+        assert np.isclose(p_value, get_enrichment(a, b, tracks[track], engine = 'native'))
+    covering = enrichments_df.set_index('track').loc['covering']
+    assert covering['a_with'] >= 250 and covering['fdr'] < 1e-10 and covering['permutation_p_value'] == 1 / 201
+    assert enrichments_df.set_index('track').loc['empty', 'p_value'] == 1
+    assert enrichments_df['b_with'].iloc[:3].min() > 0
+    assert (enrichments_df['fdr'] >= enrichments_df['p_value']).all()
+
+    # permutations are reproducible whatever the number of jobs
+    assert enrichments_df.equals(get_enrichments(a, b, tracks, permutations = 200, n_jobs = 1))
+    assert np.allclose(get_fdr([0.01, 0.04, 0.03, 0.2]), [0.04, 0.16 / 3, 0.16 / 3, 0.2])
+
 if __name__ == '__main__':
     test_correct_fragment_order()
     test_get_interaction_types()
+    test_get_fragment_element_overlaps()
     test_get_interaction_elements()
+    test_get_swept_interaction_elements()
+    test_get_interaction_element_indices()
+    test_get_enrichments()
@@ -0,0 +1,375 @@
+import chromatics
+import numpy as np
+import pandas as pd
+
+# native replacements for the bedtools operations used by the pipeline
+# intervals are 0-based half-open, two intervals overlap if a.start < b.end and b.start < a.end
+
+def get_coordinates(df):
+    chroms = np.asarray(df.iloc[:, 0]).astype(str)
+    starts = np.asarray(df.iloc[:, 1], dtype = np.int64)
+    ends = np.asarray(df.iloc[:, 2], dtype = np.int64)
+    return chroms, starts, ends
+
+def get_chrom_groups(left_chroms, right_chroms):
+    # yields (chrom, left positions, right positions) for chromosomes present in both inputs
+    codes, uniques = pd.factorize(np.concatenate([left_chroms, right_chroms]))
+    left_codes = codes[:len(left_chroms)]
+    right_codes = codes[len(left_chroms):]
+
+    left_order = np.argsort(left_codes, kind = 'mergesort')
+    right_order = np.argsort(right_codes, kind = 'mergesort')
+    left_bounds = np.searchsorted(left_codes[left_order], np.arange(len(uniques) + 1))
+    right_bounds = np.searchsorted(right_codes[right_order], np.arange(len(uniques) + 1))
+
+    for code, chrom in enumerate(uniques):
+        left_positions = left_order[left_bounds[code]:left_bounds[code + 1]]
+        right_positions = right_order[right_bounds[code]:right_bounds[code + 1]]
+        if len(left_positions) > 0 and len(right_positions) > 0:
+            yield chrom, left_positions, right_positions
+
+def expand_ranges(lower_bounds, upper_bounds):
+    # vectorized equivalent of concatenating range(lo, hi) for each pair of bounds
+    counts = np.maximum(upper_bounds - lower_bounds, 0)
+    owners = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owners, np.repeat(lower_bounds, counts) + offsets
+
+def get_sorted_overlap_pairs(left_starts, left_ends, right_starts, right_ends, max_length = None, left_fraction = None, right_fraction = None):
+    # single-chromosome overlap join, right intervals must be sorted by start
+    if max_length is None:
+        max_length = (right_ends - right_starts).max() if len(right_starts) > 0 else 0
+
+    # any overlapping right interval starts before the left end and no earlier than max_length before the left start
+    lower_bounds = np.searchsorted(right_starts, left_starts - max_length, side = 'right')
+    upper_bounds = np.searchsorted(right_starts, left_ends, side = 'left')
+    owners, candidates = expand_ranges(lower_bounds, upper_bounds)
+
+    overlaps = np.minimum(left_ends[owners], right_ends[candidates]) - np.maximum(left_starts[owners], right_starts[candidates])
+    mask = overlaps > 0
+    if left_fraction is not None:
+        mask &= overlaps >= left_fraction * (left_ends[owners] - left_starts[owners])
+    if right_fraction is not None:
+        mask &= overlaps >= right_fraction * (right_ends[candidates] - right_starts[candidates])
+    return owners[mask], candidates[mask]
+
+def get_overlap_pairs(left_df, right_df, left_fraction = None, right_fraction = None):
+    # returns positional indices of every overlapping (left, right) pair, ordered by left position
+    left_chroms, left_starts, left_ends = get_coordinates(left_df)
+    right_chroms, right_starts, right_ends = get_coordinates(right_df)
+
+    left_indices = []
+    right_indices = []
+    for chrom, left_positions, right_positions in get_chrom_groups(left_chroms, right_chroms):
+        right_positions = right_positions[np.argsort(right_starts[right_positions], kind = 'mergesort')]
+        owners, candidates = get_sorted_overlap_pairs(
+            left_starts[left_positions],
+            left_ends[left_positions],
+            right_starts[right_positions],
+            right_ends[right_positions],
+            left_fraction = left_fraction,
+            right_fraction = right_fraction)
+        left_indices.append(left_positions[owners])
+        right_indices.append(right_positions[candidates])
+
+    if len(left_indices) == 0:
+        return np.array([], dtype = np.int64), np.array([], dtype = np.int64)
+    left_indices = np.concatenate(left_indices)
+    right_indices = np.concatenate(right_indices)
+    order = np.argsort(left_indices, kind = 'mergesort')
+    return left_indices[order], right_indices[order]
+
+def count_overlaps(left_df, right_df):
+    # number of right intervals overlapping each left interval without materializing pairs:
+    # overlapping = (right starts before left end) - (right ends at or before left start)
+    left_chroms, left_starts, left_ends = get_coordinates(left_df)
+    right_chroms, right_starts, right_ends = get_coordinates(right_df)
+
+    counts = np.zeros(len(left_df), dtype = np.int64)
+    for chrom, left_positions, right_positions in get_chrom_groups(left_chroms, right_chroms):
+        sorted_starts = np.sort(right_starts[right_positions])
+        sorted_ends = np.sort(right_ends[right_positions])
+        counts[left_positions] = \
+            np.searchsorted(sorted_starts, left_ends[left_positions], side = 'left') - \
+            np.searchsorted(sorted_ends, left_starts[left_positions], side = 'right')
+    return counts
+
+def count_overlap_pairs(left_df, right_df, left_fraction = None, right_fraction = None):
+    if left_fraction is None and right_fraction is None:
+        return count_overlaps(left_df, right_df)
+    left_indices, _ = get_overlap_pairs(left_df, right_df, left_fraction, right_fraction)
+    return np.bincount(left_indices, minlength = len(left_df))
+
+def count_dominated(left_starts, left_ends, right_starts, right_ends):
+    # number of right intervals, sorted by start, with start >= left start and end <= left end, for nested right intervals
+    # right intervals starting at or after a left start are a suffix, so the count is (ends at or before the left end)
+    # minus the same among the prefix before it, which splits into aligned blocks of 2**level intervals, one per set bit
+    # of the prefix length; each level sorts ends within its blocks and answers its blocks by one searchsorted
+    # pass, O((n + m) log**2 m), with lefts ordered by start so the queries of a level arrive nearly sorted
+    max_end = right_ends.max()
+    stride = np.int64(max_end) + 1
+    left_order = np.lexsort((left_ends, left_starts))
+    prefix_lengths = np.searchsorted(right_starts, left_starts[left_order], side = 'left')
+    left_ends = np.minimum(left_ends[left_order], max_end)
+
+    prefix_counts = np.zeros(len(left_order), dtype = np.int64)
+    right_positions = np.arange(len(right_ends), dtype = np.int64)
+    level = 0
+    while (1 << level) <= len(right_ends):
+        queries = np.flatnonzero((prefix_lengths >> level) & 1)
+        if len(queries) > 0:
+            block_keys = np.sort((right_positions >> level) * stride + right_ends)
+            blocks = (prefix_lengths[queries] >> level) - 1
+            prefix_counts[queries] += np.searchsorted(block_keys, blocks * stride + left_ends[queries], side = 'right') - (blocks << level)
+        level += 1
+
+    counts = np.empty(len(left_order), dtype = np.int64)
+    counts[left_order] = np.searchsorted(np.sort(right_ends), left_ends, side = 'right') - prefix_counts
+    return counts
+
+def count_contained(left_df, right_df):
+    # number of right intervals lying entirely within each left interval, like coverage -counts -F 1.0
+    # when no right interval nests inside another on its chromosome (points, fixed-width bins, ...) right intervals
+    # sorted by start are also sorted by end, and the count is (ending at or before the left end) - (starting before the left start)
+    # otherwise (e.g. windows) counts come from count_dominated, neither enumerates overlaps
+    left_chroms, left_starts, left_ends = get_coordinates(left_df)
+    right_chroms, right_starts, right_ends = get_coordinates(right_df)
+
+    counts = np.zeros(len(left_df), dtype = np.int64)
+    for chrom, left_positions, right_positions in get_chrom_groups(left_chroms, right_chroms):
+        right_positions = right_positions[np.lexsort((right_ends[right_positions], right_starts[right_positions]))]
+        sorted_starts = right_starts[right_positions]
+        sorted_ends = right_ends[right_positions]
+        if (np.diff(sorted_ends) < 0).any():
+            counts[left_positions] = count_dominated(left_starts[left_positions], left_ends[left_positions], sorted_starts, sorted_ends)
+        else:
+            counts[left_positions] = np.maximum(
+                np.searchsorted(sorted_ends, left_ends[left_positions], side = 'right') -
+                np.searchsorted(sorted_starts, left_starts[left_positions], side = 'left'),
+                0)
+    return counts
+
+def merge_intervals(df):
+    chroms, starts, ends = get_coordinates(df)
+    if len(chroms) == 0:
+        return chroms, starts, ends
+    order = np.lexsort((starts, chroms))
+    chroms, starts, ends = chroms[order], starts[order], ends[order]
+
+    # offset each chromosome so a single running maximum never crosses chromosome boundaries
+    chrom_offsets = (np.cumsum(np.r_[True, chroms[1:] != chroms[:-1]]) - 1) * 2**40
+    running_ends = np.maximum.accumulate(ends + chrom_offsets)
+
+    # like bedtools, merge overlapping and book-ended intervals
+    block_starts = np.r_[True, starts[1:] + chrom_offsets[1:] > running_ends[:-1]]
+    block_ends = np.zeros(block_starts.sum(), dtype = np.int64)
+    np.maximum.at(block_ends, np.cumsum(block_starts) - 1, ends)
+    return chroms[block_starts], starts[block_starts], block_ends
+
+def get_closest_pairs(left_df, right_df):
+    # returns (left, right, distance) indices for the closest right interval(s) of each left interval, all ties reported
+    # overlapping intervals have distance 0, book-ended intervals have distance 1 as in bedtools
+    left_chroms, left_starts, left_ends = get_coordinates(left_df)
+    right_chroms, right_starts, right_ends = get_coordinates(right_df)
+
+    overlap_left_indices, overlap_right_indices = get_overlap_pairs(left_df, right_df)
+    has_overlap = np.zeros(len(left_df), dtype = bool)
+    has_overlap[overlap_left_indices] = True
+
+    left_indices = [overlap_left_indices]
+    right_indices = [overlap_right_indices]
+    distances = [np.zeros(len(overlap_left_indices), dtype = np.int64)]
+    for chrom, left_positions, right_positions in get_chrom_groups(left_chroms, right_chroms):
+        left_positions = left_positions[~has_overlap[left_positions]]
+        if len(left_positions) == 0:
+            continue
+
+        by_start = right_positions[np.argsort(right_starts[right_positions], kind = 'mergesort')]
+        by_end = right_positions[np.argsort(right_ends[right_positions], kind = 'mergesort')]
+        sorted_starts = right_starts[by_start]
+        sorted_ends = right_ends[by_end]
+
+        # nearest upstream intervals end at the largest end <= left start, nearest downstream start at the smallest start >= left end
+        upstream_upper = np.searchsorted(sorted_ends, left_starts[left_positions], side = 'right')
+        upstream_end = sorted_ends[np.maximum(upstream_upper - 1, 0)]
+        upstream_lower = np.searchsorted(sorted_ends, upstream_end, side = 'left')
+        upstream_distance = np.where(upstream_upper > 0, left_starts[left_positions] - upstream_end + 1, np.iinfo(np.int64).max)
+
+        downstream_lower = np.searchsorted(sorted_starts, left_ends[left_positions], side = 'left')
+        downstream_start = sorted_starts[np.minimum(downstream_lower, len(sorted_starts) - 1)]
+        downstream_upper = np.searchsorted(sorted_starts, downstream_start, side = 'right')
+        downstream_distance = np.where(downstream_lower < len(sorted_starts), downstream_start - left_ends[left_positions] + 1, np.iinfo(np.int64).max)
+
+        distance = np.minimum(upstream_distance, downstream_distance)
+        upstream_mask = (upstream_upper > 0) & (upstream_distance == distance)
+        downstream_mask = (downstream_lower < len(sorted_starts)) & (downstream_distance == distance)
+
+        owners, candidates = expand_ranges(upstream_lower[upstream_mask], upstream_upper[upstream_mask])
+        left_indices.append(left_positions[upstream_mask][owners])
+        right_indices.append(by_end[candidates])
+        distances.append(distance[upstream_mask][owners])
+
+        owners, candidates = expand_ranges(downstream_lower[downstream_mask], downstream_upper[downstream_mask])
+        left_indices.append(left_positions[downstream_mask][owners])
+        right_indices.append(by_start[candidates])
+        distances.append(distance[downstream_mask][owners])
+
+    left_indices = np.concatenate(left_indices)
+    right_indices = np.concatenate(right_indices)
+    distances = np.concatenate(distances)
+    order = np.lexsort((right_starts[right_indices], left_indices))
+    return left_indices[order], right_indices[order], distances[order]
+
+def parse_operation(operation):
+    tokens = operation.split()
+    command, flags, options = tokens[0], set(), {}
+    i = 1
+    while i < len(tokens):
+        if tokens[i] in {'-f', '-F'}:
+            options[tokens[i]] = float(tokens[i + 1])
+            i += 2
+        else:
+            flags.add(tokens[i])
+            i += 1
+    return command, flags, options
+
+def set_names(df, names):
+    # like reading bedtools output with read_bed, trailing names without a field become NaN columns
+    df.columns = names[:df.shape[1]]
+    for name in names[df.shape[1]:]:
+        df[name] = np.nan
+    return df
+
+def take_rows(df, indices, names):
+    rows_df = df.iloc[indices].reset_index(drop = True)
+    rows_df.columns = names
+    return rows_df
+
+def native_bedtools(operation, left_input, right_input = None, left_names = None, right_names = None):
+    command, flags, options = parse_operation(operation)
+    unsupported_flags = flags - {'-wa', '-wb', '-wo', '-u', '-c', '-counts', '-sorted', '-d'}
+    if len(unsupported_flags) > 0:
+        raise Exception('Unsupported native bedtools flags: {}'.format(' '.join(sorted(unsupported_flags))))
+
+    # filenames are parsed once, dataframes are used as-is
+    left_df = left_input if isinstance(left_input, pd.DataFrame) else chromatics.read_bed(left_input, names = left_names)
+    right_df = right_input if isinstance(right_input, pd.DataFrame) or right_input is None else chromatics.read_bed(right_input, names = right_names)
+    left_names = left_df.columns.tolist() if left_names is None else list(left_names)
+    if right_df is not None:
+        right_names = right_df.columns.tolist() if right_names is None else list(right_names)
+    names = chromatics.get_bedtools_names(operation, left_names, right_names)
+
+    left_fraction = options.get('-f')
+    right_fraction = options.get('-F')
+
+    if command == 'intersect':
+        if '-c' in flags:
+            counts_df = take_rows(left_df, slice(None), left_names)
+            counts_df['count'] = count_overlap_pairs(left_df, right_df, left_fraction, right_fraction)
+            return set_names(counts_df, names)
+        elif '-u' in flags:
+            hits = count_overlap_pairs(left_df, right_df, left_fraction, right_fraction) > 0
+            return take_rows(left_df, np.flatnonzero(hits), names)
+
+        left_indices, right_indices = get_overlap_pairs(left_df, right_df, left_fraction, right_fraction)
+        left_rows_df = take_rows(left_df, left_indices, left_names)
+        right_rows_df = take_rows(right_df, right_indices, right_names)
+
+        if '-wo' in flags:
+            _, left_starts, left_ends = get_coordinates(left_rows_df)
+            _, right_starts, right_ends = get_coordinates(right_rows_df)
+            intersection_df = pd.concat([left_rows_df, right_rows_df], axis = 1)
+            intersection_df['overlap'] = np.minimum(left_ends, right_ends) - np.maximum(left_starts, right_starts)
+        elif '-wa' in flags and '-wb' in flags:
+            intersection_df = pd.concat([left_rows_df, right_rows_df], axis = 1)
+        elif '-wa' in flags:
+            intersection_df = left_rows_df
+        elif '-wb' in flags:
+            intersection_df = right_rows_df
+        else:
+            # without -wa or -wb bedtools reports the overlapping portion of each left interval
+            intersection_df = left_rows_df
+            intersection_df.iloc[:, 1] = np.maximum(intersection_df.iloc[:, 1].values, right_rows_df.iloc[:, 1].values)
+            intersection_df.iloc[:, 2] = np.minimum(intersection_df.iloc[:, 2].values, right_rows_df.iloc[:, 2].values)
+        intersection_df.columns = names
+        return intersection_df
+
+    elif command == 'coverage':
+        if '-counts' not in flags:
+            raise Exception('Native coverage only supports -counts')
+        coverage_df = take_rows(left_df, slice(None), left_names)
+        coverage_df['count'] = count_overlap_pairs(left_df, right_df, left_fraction, right_fraction)
+        return set_names(coverage_df, names)
+
+    elif command == 'merge':
+        chroms, starts, ends = merge_intervals(left_df)
+        return set_names(pd.DataFrame({0: chroms, 1: starts, 2: ends}), names)
+
+    elif command == 'closest':
+        left_indices, right_indices, distances = get_closest_pairs(left_df, right_df)
+
+        # left intervals without any right interval on their chromosome are reported with placeholder fields
+        missing = np.setdiff1d(np.arange(len(left_df)), left_indices)
+        closest_df = pd.concat([take_rows(left_df, left_indices, left_names), take_rows(right_df, right_indices, right_names)], axis = 1)
+        if len(missing) > 0:
+            missing_df = take_rows(left_df, missing, left_names)
+            for i, name in enumerate(right_names):
+                missing_df[name] = -1 if i in {1, 2} else '.'
+            closest_df = pd.concat([closest_df, missing_df], ignore_index = True)
+            distances = np.concatenate([distances, np.full(len(missing), -1, dtype = np.int64)])
+            order = np.argsort(np.concatenate([left_indices, missing]), kind = 'mergesort')
+            closest_df = closest_df.iloc[order].reset_index(drop = True)
+            distances = distances[order]
+        if '-d' in flags:
+            closest_df['distance'] = distances
+        closest_df.columns = names
+        return closest_df
+
+    raise Exception('Unsupported native bedtools operation: {}'.format(command))
+
+def test_native_intersect():
+    enhancers_df = chromatics.read_bed('enhancers.bed', names = chromatics.enhancer_bed_columns)
+    peaks_df = chromatics.read_bed('peaks.bed', names = chromatics.signal_bed_columns[:3] + ['dataset', 'signal_value'])
+
+    intersection_df = native_bedtools('intersect -wa -wb', enhancers_df, peaks_df)
+    assert intersection_df.columns.tolist() == chromatics.enhancer_bed_columns + peaks_df.columns.tolist()
+    assert intersection_df['signal_value'].tolist() == [100, 110, 50.2]
+
+    assert native_bedtools('intersect -u', enhancers_df, peaks_df)['enhancer_name'].tolist() == ['enhancer1']
+    assert native_bedtools('intersect -c', enhancers_df, peaks_df)['count'].tolist() == [3, 0]
+    assert native_bedtools('intersect -u -f 1.0', peaks_df, enhancers_df)['signal_value'].tolist() == [100, 110]
+    assert native_bedtools('coverage -counts -F 1.0', enhancers_df, peaks_df, right_names = ['count'])['count'].tolist() == [2, 0]
+    print(intersection_df)
+
+def test_count_contained():
+    windows_df = chromatics.get_random_pairs(500, 'window', 'point', random_state = 1)
+    points_df = windows_df[['point_chrom', 'point_start']].copy()
+    points_df['point_end'] = points_df['point_start'] + 1
+    windows_df = windows_df[chromatics.window_bed_columns]
+
+    # points cannot nest, windows can, and nested windows sharing starts or ends are counted once each
+    nested_df = pd.concat([windows_df, windows_df.assign(window_end = windows_df['window_start'] + 1)], ignore_index = True)
+    for intervals_df in [points_df, windows_df, nested_df]:
+        expected = native_bedtools('coverage -counts -F 1.0', windows_df, intervals_df, right_names = ['count'])['count'].values
+        assert (count_contained(windows_df, intervals_df) == expected).all()
+        assert expected.sum() > 0
+
+    expected = native_bedtools('coverage -counts', windows_df, points_df, right_names = ['count'])['count'].values
+    assert (count_overlaps(windows_df, points_df) == expected).all()
+
+def test_native_merge_and_closest():
+    peaks_df = chromatics.read_bed('peaks.bed', names = chromatics.signal_bed_columns[:3] + ['dataset', 'signal_value'])
+    merged_df = native_bedtools('merge', peaks_df)
+    assert merged_df.iloc[:, 1].tolist() == [200, 250, 10000]
+    assert merged_df.iloc[:, 2].tolist() == [220, 380, 10100]
+
+    promoters_df = chromatics.read_bed('promoters.bed', names = chromatics.promoter_bed_columns)
+    closest_df = native_bedtools('closest -d', peaks_df, promoters_df)
+    assert closest_df['promoter_name'].tolist() == ['promoter3', 'promoter3', 'promoter3', 'promoter1']
+    assert closest_df['distance'].tolist() == [1781, 1701, 1621, 4901]
+    print(closest_df)
+
+if __name__ == '__main__':
+    test_native_intersect()
+    test_count_contained()
+    test_native_merge_and_closest()
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import pickle
+import shutil
+import sklearn.externals.joblib as joblib
+import tempfile
+
+from sklearn.base import clone
+from sklearn.cross_validation import StratifiedKFold
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.metrics import f1_score
+
+# cross-validation, feature importances, and recursive feature elimination sharing one float32 predictor matrix
+# saved as a .npy file that joblib workers memory-map, so tasks receive only row and column positions
+# every fit is pickled under cache_dir by a key of its task, so an interrupted run resumes from the fits it finished
+
+def get_modeling_data(training_df, config):
+    # predictors and labels as laid out by a config, indexed by sample names
+    training_df = training_df.set_index(config['sample_name_variables'])
+    predictors_df = training_df.drop(config['nonpredictor_variables'] + [config['dependent_variable']], axis = 1)
+    return predictors_df, training_df[config['dependent_variable']]
+
+def get_modeling_key(training_fn, config, fold_count):
+    # identifies the training data and settings that all cached fits depend on
+    stat = os.stat(training_fn)
+    settings = [stat.st_size, stat.st_mtime_ns, fold_count] + [config[_] for _ in ['dependent_variable', 'sample_name_variables', 'nonpredictor_variables']]
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()[:16]
+
+def share_predictors(predictors_df, predictors_fn):
+    if not os.path.exists(predictors_fn):
+        tmp_fn = '{}.{}.tmp.npy'.format(predictors_fn[:-len('.npy')], os.getpid())
+        np.save(tmp_fn, predictors_df.values.astype(np.float32))
+        os.replace(tmp_fn, predictors_fn)
+    return predictors_fn
+
+def get_task_key(task, estimator):
+    return hashlib.sha1(json.dumps([task, repr(sorted(estimator.get_params().items()))]).encode()).hexdigest()
+
+def run_cached(cache_dir, task_key, function, *args):
+    # pickled rather than joblib.dump, which may split arrays into separate files
+    task_fn = os.path.join(cache_dir, task_key + '.pkl')
+    if os.path.exists(task_fn):
+        with open(task_fn, 'rb') as task_file:
+            return pickle.load(task_file)
+    result = function(*args)
+    tmp_fn = '{}.{}.tmp'.format(task_fn, os.getpid())
+    with open(tmp_fn, 'wb') as tmp_file:
+        pickle.dump(result, tmp_file)
+    os.replace(tmp_fn, task_fn)
+    return result
+
+def fit_estimator(predictors_fn, labels, rows, features, estimator):
+    # only the selected block of the memory-mapped predictors is copied into the worker
+    predictors = np.load(predictors_fn, mmap_mode = 'r')
+    features = np.arange(predictors.shape[1]) if features is None else features
+    estimator = clone(estimator)
+    estimator.fit(predictors[np.ix_(rows, features)], labels[rows])
+    return estimator
+
+def predict_fold(predictors_fn, labels, train, test, features, estimator):
+    predictors = np.load(predictors_fn, mmap_mode = 'r')
+    features = np.arange(predictors.shape[1]) if features is None else features
+    estimator = fit_estimator(predictors_fn, labels, train, features, estimator)
+    return estimator.predict(predictors[np.ix_(test, features)]), getattr(estimator, 'feature_importances_', None)
+
+def get_importances(predictors_fn, labels, estimator, random_state):
+    # relative importances, scaled so the most important feature is 100
+    estimator = clone(estimator).set_params(random_state = random_state)
+    estimator = fit_estimator(predictors_fn, labels, np.arange(len(labels)), None, estimator)
+    return 100 * estimator.feature_importances_ / estimator.feature_importances_.max()
+
+def get_feature_counts(feature_count):
+    # powers of two up to half the full feature count, largest first
+    return [2**_ for _ in reversed(range(int(np.log2(feature_count / 2)) + 1))]
+
+def eliminate_fold(predictors_fn, labels, train, test, estimator, cache_dir, task):
+    # f1 on the test fold as features are halved, each step keeping the most important features of the previous fit
+    # steps are cached individually so a fold resumes from its last finished step
+    features = np.arange(np.load(predictors_fn, mmap_mode = 'r').shape[1])
+    _, importances = run_cached(cache_dir, get_task_key(task + [len(features)], estimator), predict_fold, predictors_fn, labels, train, test, features, estimator)
+    scores = {}
+    for feature_count in get_feature_counts(len(features)):
+        features = features[np.argsort(-importances, kind = 'mergesort')[:feature_count]]
+        predictions, importances = run_cached(cache_dir, get_task_key(task + [feature_count], estimator), predict_fold, predictors_fn, labels, train, test, features, estimator)
+        scores[feature_count] = f1_score(labels[test], predictions)
+    return scores
+
+def get_folds(labels, fold_count, random_state = 0):
+    return list(StratifiedKFold(labels, n_folds = fold_count, shuffle = True, random_state = random_state))
+
+def cross_validate(predictors_fn, labels, folds, estimator, parallel, cache_dir):
+    # out-of-fold predictions, in the order of the concatenated test sets
+    results = parallel(
+        joblib.delayed(run_cached)(cache_dir, get_task_key(['predict', fold_number], estimator), predict_fold, predictors_fn, labels, train, test, None, estimator)
+        for fold_number, (train, test) in enumerate(folds))
+    return np.concatenate([test for train, test in folds]), np.concatenate([predictions for predictions, importances in results])
+
+def get_feature_importances(predictors_fn, labels, feature_names, estimator, seed_count, parallel, cache_dir):
+    results = parallel(
+        joblib.delayed(run_cached)(cache_dir, get_task_key(['importances', seed], estimator), get_importances, predictors_fn, labels, estimator, seed)
+        for seed in range(seed_count))
+    importances_df = pd.DataFrame(results, columns = feature_names)
+    importances_df = pd.DataFrame({'mean': importances_df.mean(), 'sem': importances_df.sem(), 'std': importances_df.std()}, columns = ['mean', 'sem', 'std'])
+    importances_df.index.name = 'feature'
+    return importances_df.sort_values('mean', ascending = False)
+
+def eliminate_features(predictors_fn, labels, folds, estimator, parallel, cache_dir):
+    # one task per fold, rows are feature counts and columns folds
+    results = parallel(
+        joblib.delayed(eliminate_fold)(predictors_fn, labels, train, test, estimator, cache_dir, ['rfe', fold_number])
+        for fold_number, (train, test) in enumerate(folds))
+    rfe_df = pd.DataFrame(results, index = ['fold{}'.format(_) for _ in range(len(folds))]).T.sort_index()
+    rfe_df.index.name = 'feature_count'
+    return rfe_df
+
+def test_cross_validate():
+    random_state = np.random.RandomState(0)
+    predictors_df = pd.DataFrame(random_state.rand(200, 10), columns = ['f{}'.format(_) for _ in range(10)])
+    labels = (predictors_df['f0'] + 0.1 * random_state.rand(200) > 0.6).astype(int).values
+    estimator = GradientBoostingClassifier(n_estimators = 10, random_state = 0)
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        predictors_fn = share_predictors(predictors_df, os.path.join(cache_dir, 'predictors.npy'))
+        folds = get_folds(labels, 4)
+        with joblib.Parallel(2) as parallel:
+            order, predictions = cross_validate(predictors_fn, labels, folds, estimator, parallel, cache_dir)
+            assert sorted(order) == list(range(200))
+            assert f1_score(labels[order], predictions) > 0.8
+
+            importances_df = get_feature_importances(predictors_fn, labels, predictors_df.columns, estimator, 3, parallel, cache_dir)
+            print(importances_df)
+            assert importances_df.index[0] == 'f0' and importances_df['mean'].iloc[0] == 100
+
+            rfe_df = eliminate_features(predictors_fn, labels, folds, estimator, parallel, cache_dir)
+            print(rfe_df)
+            assert rfe_df.index.tolist() == [1, 2, 4] and rfe_df.shape[1] == 4
+            assert (rfe_df.loc[1] > 0.8).all()
+
+            # a rerun only reads cached fits
+            cached_fns = sorted(os.listdir(cache_dir))
+            assert rfe_df.equals(eliminate_features(predictors_fn, labels, folds, estimator, parallel, cache_dir))
+            assert sorted(os.listdir(cache_dir)) == cached_fns
+    finally:
+        shutil.rmtree(cache_dir)
+
+if __name__ == '__main__':
+    test_cross_validate()
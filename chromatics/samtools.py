@@ -1,14 +1,154 @@
 import chromatics
+import csv
 import io
+import numpy as np
 import pandas as pd
 import subprocess
 
+# https://samtools.github.io/hts-specs/SAMv1.pdf, optional tags are ignored
+sam_columns = ['read_name', 'flag', 'chrom', 'pos', 'mapq', 'cigar', 'mate_chrom', 'mate_pos', 'template_length', 'sequence', 'quality']
+sam_dtypes = {'read_name': str, 'flag': np.uint16, 'chrom': 'category', 'pos': np.int32, 'mapq': np.uint8, 'mate_chrom': 'category', 'mate_pos': np.int32, 'template_length': np.int32}
+
 def samtools(arguments):
     cmdline = 'samtools {}'.format(arguments)
     p = subprocess.Popen(cmdline, shell = True, stdout = subprocess.PIPE)
     stdout, _ = p.communicate()
     return chromatics.read_bed(io.StringIO(stdout.decode('utf-8'))).set_index(0)
 
+def read_sam_batches(sam_file, batch_size = 2**20, usecols = sam_columns[:5]):
+    # typed record batches from headerless sam text, the whole input is never resident
+    # sam is unquoted, and quality strings may contain quote and comment characters (phred 1 and 2)
+    dtypes = {column: sam_dtypes[column] for column in usecols if column in sam_dtypes}
+    for batch_df in pd.read_csv(sam_file, sep = '\t', header = None, names = sam_columns, usecols = usecols, dtype = dtypes, index_col = False, quoting = csv.QUOTE_NONE, comment = None, chunksize = batch_size):
+        yield batch_df.reset_index(drop = True)
+
+def iter_sam_batches(bam_fn, batch_size = 2**20, min_mapq = None, region = None, exclude_flags = None, usecols = sam_columns[:5]):
+    # streams samtools view output, filtering by mapq, flags, and region (which needs an index) inside samtools
+    args = ['samtools', 'view']
+    if min_mapq is not None:
+        args += ['-q', str(min_mapq)]
+    if exclude_flags is not None:
+        args += ['-F', str(exclude_flags)]
+    args.append(bam_fn)
+    if region is not None:
+        args.append(region)
+
+    p = subprocess.Popen(args, stdout = subprocess.PIPE)
+    try:
+        yield from read_sam_batches(p.stdout, batch_size, usecols)
+    finally:
+        p.stdout.close()
+        p.wait()
+
+def get_read_fragments(batch_df, fragments_df):
+    # position of the fragment containing each read's leftmost base, -1 if none
+    # fragments are non-overlapping, like restriction digests
+    fragment_chroms, fragment_starts, fragment_ends = chromatics.get_coordinates(fragments_df)
+    read_chroms = np.asarray(batch_df['chrom']).astype(str)
+    read_starts = batch_df['pos'].values.astype(np.int64) - 1
+
+    read_fragments = np.full(len(batch_df), -1, dtype = np.int64)
+    for chrom, read_positions, fragment_positions in chromatics.get_chrom_groups(read_chroms, fragment_chroms):
+        fragment_positions = fragment_positions[np.argsort(fragment_starts[fragment_positions], kind = 'mergesort')]
+        candidates = np.searchsorted(fragment_starts[fragment_positions], read_starts[read_positions], side = 'right') - 1
+        candidates = fragment_positions[np.maximum(candidates, 0)]
+        contained = (fragment_starts[candidates] <= read_starts[read_positions]) & (read_starts[read_positions] < fragment_ends[candidates])
+        read_fragments[read_positions[contained]] = candidates[contained]
+    return read_fragments
+
+def get_contact_keys(first_fragments, second_fragments, fragment_count):
+    # unordered fragment pair keys, pairs with an unassigned read are dropped
+    assigned = (first_fragments >= 0) & (second_fragments >= 0)
+    lower = np.minimum(first_fragments, second_fragments)[assigned]
+    upper = np.maximum(first_fragments, second_fragments)[assigned]
+    return lower * fragment_count + upper
+
+def merge_contact_counts(keys, counts):
+    # one (key, count) table from several, counts of repeated keys summed
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse = True)
+    return keys, np.bincount(inverse, weights = np.concatenate(counts), minlength = len(keys)).astype(np.int64)
+
+def count_fragment_contacts(batches, fragments_df, left_fragment_columns = None, right_fragment_columns = None, merge_interval = 16):
+    # contact counts between fragment pairs from name-grouped read batches (e.g. hicup output)
+    # mates are consecutive records with the same name, a read whose mate was filtered out is dropped
+    # and a pair split across batches is completed with the next batch
+    # each batch is reduced to counts per fragment pair, merged into a running table every merge_interval batches,
+    # so memory is bounded by the number of distinct fragment pairs rather than of read pairs
+    left_fragment_columns = left_fragment_columns or ['f1_' + _ for _ in chromatics.generic_bed_columns]
+    right_fragment_columns = right_fragment_columns or ['f2_' + _ for _ in chromatics.generic_bed_columns]
+    contact_keys = [np.array([], dtype = np.int64)]
+    contact_counts = [np.array([], dtype = np.int64)]
+    carried_df = None
+
+    for batch_df in batches:
+        if carried_df is not None:
+            batch_df = pd.concat([carried_df, batch_df], ignore_index = True)
+        names = batch_df['read_name'].values
+        run_starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]])
+        run_lengths = np.diff(np.r_[run_starts, len(names)])
+
+        # the last name may continue in the next batch
+        carried_df = batch_df.iloc[run_starts[-1]:].reset_index(drop = True)
+        run_starts = run_starts[:-1]
+        run_lengths = run_lengths[:-1]
+
+        read_fragments = get_read_fragments(batch_df, fragments_df)
+        first_fragments = read_fragments[run_starts[run_lengths == 2]]
+        second_fragments = read_fragments[run_starts[run_lengths == 2] + 1]
+        keys, counts = np.unique(get_contact_keys(first_fragments, second_fragments, len(fragments_df)), return_counts = True)
+        contact_keys.append(keys)
+        contact_counts.append(counts)
+        if len(contact_keys) > merge_interval:
+            keys, counts = merge_contact_counts(contact_keys, contact_counts)
+            contact_keys = [keys]
+            contact_counts = [counts]
+
+    if carried_df is not None and len(carried_df) == 2:
+        read_fragments = get_read_fragments(carried_df, fragments_df)
+        contact_keys.append(get_contact_keys(read_fragments[:1], read_fragments[1:], len(fragments_df)))
+        contact_counts.append(np.ones(len(contact_keys[-1]), dtype = np.int64))
+
+    keys, counts = merge_contact_counts(contact_keys, contact_counts)
+    contacts_df = pd.concat([
+        fragments_df.iloc[keys // len(fragments_df)].reset_index(drop = True).set_axis(left_fragment_columns, axis = 1),
+        fragments_df.iloc[keys % len(fragments_df)].reset_index(drop = True).set_axis(right_fragment_columns, axis = 1)
+        ], axis = 1)
+    contacts_df['count'] = counts
+    return contacts_df
+
+def test_count_fragment_contacts():
+    sam = '\n'.join([
+        'r1\t65\tchr1\t101\t40\t50M\t=\t301\t0\tACGT\tIIII\tAS:i:0',
+        'r1\t129\tchr1\t301\t40\t50M\t=\t101\t0\tACGT\tI@II',
+        'r2\t65\tchr1\t350\t40\t50M\tchr2\t6\t0\tACGT\tIIII',
+        'r2\t129\tchr2\t6\t40\t50M\tchr1\t350\t0\tACGT\tIIII\tXS:i:1',
+        'r3\t65\tchr1\t120\t40\t50M\t=\t290\t0\tACGT\tIIII',
+        'r4\t65\tchr1\t150\t40\t50M\t=\t390\t0\tACGT\tI"#I',
+        'r4\t129\tchr1\t390\t40\t50M\t=\t150\t0\tACGT\tIIII',
+        'r5\t65\tchr3\t1\t40\t50M\t=\t5\t0\tACGT\tIIII',
+        'r5\t129\tchr3\t5\t40\t50M\t=\t1\t0\tACGT\tIIII'
+        ])
+    fragments_df = pd.DataFrame({
+        'chrom': ['chr1', 'chr1', 'chr2'],
+        'start': [0, 200, 0],
+        'end': [200, 400, 100],
+        'name': ['a', 'b', 'c']
+        })
+
+    batches = list(read_sam_batches(io.StringIO(sam), batch_size = 3))
+    assert [len(_) for _ in batches] == [3, 3, 3]
+    assert batches[0]['chrom'].dtype == 'category' and batches[0]['mapq'].dtype == np.uint8
+    assert next(read_sam_batches(io.StringIO(sam), usecols = ['read_name', 'quality']))['quality'][5] == 'I"#I'
+
+    # r3 lost its mate and r5 falls outside every fragment
+    contacts_df = count_fragment_contacts(read_sam_batches(io.StringIO(sam), batch_size = 3), fragments_df)
+    print(contacts_df)
+    assert contacts_df[['f1_name', 'f2_name', 'count']].values.tolist() == [['a', 'b', 2], ['b', 'c', 1]]
+
+    # running merges after every batch give the same counts
+    merged_df = count_fragment_contacts(read_sam_batches(io.StringIO(sam), batch_size = 2), fragments_df, merge_interval = 1)
+    assert merged_df.equals(contacts_df)
+
 if __name__ == '__main__':
     reads_df = samtools('view test_dataset1_2.hicup.bam')
     print(reads_df[reads_df[4] < 30])
@@ -17,3 +157,5 @@ if __name__ == '__main__':
     reads_df = samtools('view -q 30 test_dataset1_2.hicup.bam')
     assert len(reads_df[reads_df[4] < 30]) == 0
     print(reads_df.loc['SRR071233.1357221'])
+
+    test_count_fragment_contacts()
@@ -0,0 +1,81 @@
+import chromatics
+import numpy as np
+import pandas as pd
+
+# compact in-memory schema for pair and training tables: categorical chromosomes, int32 coordinates,
+# float32 features, and names (*_name, interaction_id) as int32 ids into a shared lookup table
+# string names are only rendered on export, missing names have id -1
+
+def is_name_column(column):
+    return column.endswith('_name') or column == 'interaction_id'
+
+def compact_pairs(pairs_df, names = None):
+    # names not already in the lookup table are appended, so ids from earlier calls stay valid
+    name_columns = [_ for _ in pairs_df.columns if is_name_column(_)]
+    stacked_names = pd.concat([pairs_df[_] for _ in name_columns], ignore_index = True).dropna()
+    names = pd.Index([] if names is None else names, dtype = object)
+    new_names = pd.Index(pd.unique(stacked_names.values), dtype = object)
+    names = names.append(new_names[~new_names.isin(names)])
+
+    compact_df = pairs_df.copy()
+    for column in name_columns:
+        compact_df[column] = names.get_indexer(pairs_df[column]).astype(np.int32)
+    for column, dtype in chromatics.get_bed_dtypes(pairs_df.columns).items():
+        if not is_name_column(column):
+            compact_df[column] = pairs_df[column].astype(dtype)
+    return compact_df, names
+
+def render_names(df, names):
+    # export copy with string names and chromosomes, numeric columns keep their compact dtypes
+    names = np.append(np.asarray(names, dtype = object), np.nan)
+    rendered_df = df.copy()
+    for column in df.columns:
+        if is_name_column(column) and pd.api.types.is_integer_dtype(df[column]):
+            rendered_df[column] = names[df[column].values]
+        elif isinstance(df[column].dtype, pd.CategoricalDtype):
+            rendered_df[column] = df[column].astype(object)
+    return rendered_df
+
+def get_min_itemsize(df, names = None):
+    # string widths of df once rendered, for appending to HDF5 tables
+    min_itemsize = {}
+    for column in df.columns:
+        if is_name_column(column) and names is not None and pd.api.types.is_integer_dtype(df[column]):
+            values = pd.Series(names, dtype = object)
+        elif isinstance(df[column].dtype, pd.CategoricalDtype):
+            values = pd.Series(df[column].cat.categories, dtype = object)
+        elif pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column]):
+            values = df[column]
+        else:
+            continue
+        min_itemsize[column] = max(int(values.astype(str).str.len().max()) if len(values) > 0 else 1, 1)
+    return min_itemsize
+
+def test_compact_pairs():
+    regions = ['enhancer', 'promoter']
+    pairs_df = chromatics.get_random_pairs(100, regions[0], regions[1])
+    pairs_df.loc[0, 'promoter_name'] = pairs_df.loc[1, 'enhancer_name']
+    compact_df, names = compact_pairs(pairs_df)
+    assert len(names) == 199
+    assert compact_df['enhancer_chrom'].dtype == 'category'
+    assert compact_df['enhancer_start'].dtype == np.int32 and compact_df['promoter_name'].dtype == np.int32
+    assert compact_df.loc[0, 'promoter_name'] == compact_df.loc[1, 'enhancer_name']
+    assert render_names(compact_df, names).astype(object).equals(pairs_df.astype(object))
+
+    # ids are stable when more pairs are added
+    more_compact_df, more_names = compact_pairs(chromatics.get_random_pairs(10, regions[0], 'window'), names)
+    assert more_names[:len(names)].equals(names) and len(more_names) == len(names) + 10
+    assert (more_compact_df['enhancer_name'].values == compact_df['enhancer_name'].values[:10]).all()
+
+    signal_df = chromatics.read_bed('wgEncodeAwgDnaseUwdukeK562UniPk.narrowPeak.gz', names = chromatics.narrowpeak_bed_columns, usecols = ['chrom', 'start', 'end', 'signal_value'])
+    signal_df['dataset'] = 'DNase'
+    generators = [(chromatics.generate_prefix_sum_signal_features, signal_df[chromatics.signal_bed_columns])]
+    training_df = chromatics.generate_training(pairs_df, regions, generators, chunk_size = 32)
+    compact_training_df = chromatics.generate_training(compact_df, regions, generators, chunk_size = 32, shared_memory = True)
+    assert compact_training_df['enhancer_chrom'].dtype == 'category'
+    assert (compact_training_df.dtypes.iloc[len(pairs_df.columns):] == np.float32).all()
+    assert render_names(compact_training_df, names)[pairs_df.columns].astype(object).equals(training_df[pairs_df.columns].astype(object))
+    assert np.allclose(compact_training_df.iloc[:, len(pairs_df.columns):].values, training_df.iloc[:, len(pairs_df.columns):].values)
+
+if __name__ == '__main__':
+    test_compact_pairs()
@@ -0,0 +1,226 @@
+import chromatics
+import json
+import numpy as np
+import os
+import pandas as pd
+
+# columnar store of signal_bed_columns data, rows sorted by (chrom, dataset, start)
+# each (chrom, dataset) pair is a contiguous block located via the offsets index
+# arrays are saved as .npy files and memory-mapped read-only so workers share pages instead of re-parsing text
+# per-block cumulative signal over sorted starts and sorted ends turns region sums into two binary searches
+
+signal_store_arrays = ['starts', 'ends', 'signal_values', 'dataset_codes', 'start_cumsums', 'sorted_ends', 'end_cumsums']
+
+def get_prefix_sums(cumsums, bounds):
+    # sum of the first bound values of a block given its inclusive cumulative sums
+    return np.where(bounds > 0, cumsums[np.maximum(bounds - 1, 0)], 0)
+
+class SignalStore:
+    def __init__(self, chroms, datasets, offsets, max_lengths, arrays, store_dir = None):
+        self.chroms = chroms
+        self.datasets = datasets
+        self.offsets = offsets
+        self.max_lengths = max_lengths
+        self.arrays = arrays
+        self.store_dir = store_dir
+        self.chrom_indices = {chrom: i for i, chrom in enumerate(chroms)}
+
+    # stores on disk are pickled by path and re-mapped on load, so joblib workers never copy the arrays
+    def __getstate__(self):
+        if self.store_dir is not None:
+            return {'store_dir': self.store_dir}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'arrays' not in state:
+            state = load_signal_store(state['store_dir']).__dict__
+        self.__dict__.update(state)
+
+    def get_block(self, chrom, dataset_code):
+        # rows holding one dataset on one chromosome, slicing the arrays with it gives zero-copy views
+        if chrom not in self.chrom_indices:
+            return slice(0, 0)
+        block = self.chrom_indices[chrom] * len(self.datasets) + dataset_code
+        return slice(self.offsets[block], self.offsets[block + 1])
+
+    def get_max_length(self, chrom, dataset_code):
+        return self.max_lengths[self.chrom_indices[chrom] * len(self.datasets) + dataset_code]
+
+    def intersect(self, regions_df):
+        # equivalent of bedtools('intersect -wa -wb', regions_df, dataset, right_names = signal_bed_columns)
+        region_chroms, region_starts, region_ends = chromatics.get_coordinates(regions_df)
+        starts = self.arrays['starts']
+        ends = self.arrays['ends']
+
+        region_indices = []
+        signal_indices = []
+        for chrom in pd.unique(region_chroms):
+            if chrom not in self.chrom_indices:
+                continue
+            region_positions = np.flatnonzero(region_chroms == chrom)
+            for dataset_code in range(len(self.datasets)):
+                block = self.get_block(chrom, dataset_code)
+                owners, candidates = chromatics.get_sorted_overlap_pairs(
+                    region_starts[region_positions],
+                    region_ends[region_positions],
+                    starts[block],
+                    ends[block],
+                    max_length = self.get_max_length(chrom, dataset_code))
+                region_indices.append(region_positions[owners])
+                signal_indices.append(candidates + block.start)
+
+        region_indices = np.concatenate(region_indices) if len(region_indices) > 0 else np.array([], dtype = np.int64)
+        signal_indices = np.concatenate(signal_indices) if len(signal_indices) > 0 else np.array([], dtype = np.int64)
+        order = np.argsort(region_indices, kind = 'mergesort')
+        region_indices = region_indices[order]
+        signal_indices = signal_indices[order]
+
+        signal_df = regions_df.iloc[region_indices].reset_index(drop = True)
+        signal_df['chrom'] = region_chroms[region_indices]
+        signal_df['start'] = starts[signal_indices]
+        signal_df['end'] = ends[signal_indices]
+        signal_df['dataset'] = np.asarray(self.datasets, dtype = object)[self.arrays['dataset_codes'][signal_indices]]
+        signal_df['signal_value'] = self.arrays['signal_values'][signal_indices]
+        return signal_df
+
+    def get_signal_sums(self, regions_df):
+        # summed signal and count of intervals overlapping each region, one column per dataset
+        sums, counts = self.get_flank_signal_sums(regions_df, [0])
+        return sums[0], counts[0]
+
+    def get_flank_signal_sums(self, regions_df, flank_sizes):
+        # get_signal_sums for the regions extended by each flank size on both sides, stacked along the first axis
+        # every flank is searched for in the same binary search per block
+        # overlapping = (intervals starting before the region end) - (intervals ending at or before the region start)
+        region_chroms, region_starts, region_ends = chromatics.get_coordinates(regions_df)
+        flank_sizes = np.asarray(flank_sizes, dtype = np.int64)[:, np.newaxis]
+        sums = np.zeros((len(flank_sizes), len(regions_df), len(self.datasets)))
+        counts = np.zeros((len(flank_sizes), len(regions_df), len(self.datasets)), dtype = np.int64)
+
+        for chrom in pd.unique(region_chroms):
+            if chrom not in self.chrom_indices:
+                continue
+            region_positions = np.flatnonzero(region_chroms == chrom)
+            flank_starts = (region_starts[region_positions] - flank_sizes).ravel()
+            flank_ends = (region_ends[region_positions] + flank_sizes).ravel()
+            for dataset_code in range(len(self.datasets)):
+                block = self.get_block(chrom, dataset_code)
+                if block.start == block.stop:
+                    continue
+                start_bounds = np.searchsorted(self.arrays['starts'][block], flank_ends, side = 'left')
+                end_bounds = np.searchsorted(self.arrays['sorted_ends'][block], flank_starts, side = 'right')
+                block_sums = \
+                    get_prefix_sums(self.arrays['start_cumsums'][block], start_bounds) - \
+                    get_prefix_sums(self.arrays['end_cumsums'][block], end_bounds)
+                sums[:, region_positions, dataset_code] = block_sums.reshape(len(flank_sizes), -1)
+                counts[:, region_positions, dataset_code] = (start_bounds - end_bounds).reshape(len(flank_sizes), -1)
+        return sums, counts
+
+    def select_datasets(self, datasets):
+        # in-memory store holding only the given datasets, blocks and their cumulative sums are copied as they are
+        codes = [self.datasets.index(_) for _ in sorted(datasets)]
+        blocks = [chrom_index * len(self.datasets) + code for chrom_index in range(len(self.chroms)) for code in codes]
+        lengths = np.diff(self.offsets)[blocks]
+        arrays = {name: np.concatenate([self.arrays[name][self.offsets[_]:self.offsets[_ + 1]] for _ in blocks]) for name in signal_store_arrays}
+        arrays['dataset_codes'] = np.repeat(np.tile(np.arange(len(codes)), len(self.chroms)), lengths).astype(np.int16)
+        offsets = np.r_[0, np.cumsum(lengths)]
+        return SignalStore(list(self.chroms), [self.datasets[_] for _ in codes], offsets, self.max_lengths[blocks], arrays)
+
+    def to_dataframe(self):
+        signal_df = pd.DataFrame({
+            'chrom': np.repeat(np.asarray(self.chroms, dtype = object), np.diff(self.offsets[::len(self.datasets)])),
+            'start': self.arrays['starts'],
+            'end': self.arrays['ends'],
+            'dataset': np.asarray(self.datasets, dtype = object)[self.arrays['dataset_codes']],
+            'signal_value': self.arrays['signal_values']
+            })
+        return signal_df[chromatics.signal_bed_columns]
+
+def get_signal_store_arrays(signal_df):
+    chroms = sorted(signal_df['chrom'].unique())
+    datasets = sorted(signal_df['dataset'].unique())
+    chrom_codes = pd.Categorical(signal_df['chrom'], categories = chroms).codes.astype(np.int64)
+    dataset_codes = pd.Categorical(signal_df['dataset'], categories = datasets).codes.astype(np.int64)
+    starts = signal_df['start'].values.astype(np.int64)
+    ends = signal_df['end'].values.astype(np.int64)
+
+    order = np.lexsort((ends, starts, dataset_codes, chrom_codes))
+    blocks = (chrom_codes * len(datasets) + dataset_codes)[order]
+    offsets = np.searchsorted(blocks, np.arange(len(chroms) * len(datasets) + 1))
+
+    lengths = (ends - starts)[order]
+    max_lengths = np.zeros(len(chroms) * len(datasets), dtype = np.int64)
+    np.maximum.at(max_lengths, blocks, lengths)
+
+    signal_values = signal_df['signal_value'].values.astype(np.float64)[order]
+    end_order = np.lexsort((ends[order], blocks))
+    start_cumsums = np.empty_like(signal_values)
+    end_cumsums = np.empty_like(signal_values)
+    for lower_bound, upper_bound in zip(offsets[:-1], offsets[1:]):
+        start_cumsums[lower_bound:upper_bound] = np.cumsum(signal_values[lower_bound:upper_bound])
+        end_cumsums[lower_bound:upper_bound] = np.cumsum(signal_values[end_order[lower_bound:upper_bound]])
+
+    arrays = {
+        'starts': starts[order],
+        'ends': ends[order],
+        'signal_values': signal_values,
+        'dataset_codes': dataset_codes[order].astype(np.int16),
+        'start_cumsums': start_cumsums,
+        'sorted_ends': ends[order][end_order],
+        'end_cumsums': end_cumsums
+        }
+    return chroms, datasets, offsets, max_lengths, arrays
+
+def read_signal_bed(x):
+    if isinstance(x, pd.DataFrame):
+        signal_df = x.copy()
+        signal_df.columns = chromatics.signal_bed_columns
+        return signal_df
+    return chromatics.read_bed(x, names = chromatics.signal_bed_columns)
+
+def get_signal_store(x):
+    # in-memory store from a DataFrame or signal bed filename
+    return SignalStore(*get_signal_store_arrays(read_signal_bed(x)))
+
+def save_signal_store(store, store_dir):
+    os.makedirs(store_dir, exist_ok = True)
+    for name in signal_store_arrays:
+        np.save(os.path.join(store_dir, '{}.npy'.format(name)), store.arrays[name])
+    np.save(os.path.join(store_dir, 'offsets.npy'), store.offsets)
+    np.save(os.path.join(store_dir, 'max_lengths.npy'), store.max_lengths)
+    with open(os.path.join(store_dir, 'index.json'), 'w') as index_file:
+        json.dump({'chroms': store.chroms, 'datasets': store.datasets}, index_file)
+    return load_signal_store(store_dir)
+
+def build_signal_store(x, store_dir):
+    return save_signal_store(get_signal_store(x), store_dir)
+
+def load_signal_store(store_dir, mmap_mode = 'r'):
+    store_dir = os.path.abspath(store_dir)
+    with open(os.path.join(store_dir, 'index.json')) as index_file:
+        index = json.load(index_file)
+    arrays = {name: np.load(os.path.join(store_dir, '{}.npy'.format(name)), mmap_mode = mmap_mode) for name in signal_store_arrays}
+    offsets = np.load(os.path.join(store_dir, 'offsets.npy'))
+    max_lengths = np.load(os.path.join(store_dir, 'max_lengths.npy'))
+    return SignalStore(index['chroms'], index['datasets'], offsets, max_lengths, arrays, store_dir)
+
+def test_signal_store():
+    enhancers_df = chromatics.read_bed('enhancers.bed', names = chromatics.enhancer_bed_columns)
+    bedtools_df = chromatics.bedtools('intersect -wa -wb', enhancers_df, 'peaks.bed', right_names = chromatics.signal_bed_columns, engine = 'native')
+
+    store = get_signal_store('peaks.bed')
+    assert store.datasets == ['CTCF', 'RAD21']
+    signal_df = store.intersect(enhancers_df)
+    assert len(signal_df) == len(bedtools_df)
+    assert sorted(signal_df['signal_value']) == sorted(bedtools_df['signal_value'])
+    print(signal_df)
+
+    rad21_store = store.select_datasets(['RAD21'])
+    rad21_sums, rad21_counts = rad21_store.get_signal_sums(enhancers_df)
+    sums, counts = store.get_signal_sums(enhancers_df)
+    assert rad21_store.datasets == ['RAD21']
+    assert np.allclose(rad21_sums[:, 0], sums[:, 1]) and (rad21_counts[:, 0] == counts[:, 1]).all()
+    assert rad21_store.to_dataframe().equals(store.to_dataframe().query('dataset == "RAD21"').reset_index(drop = True))
+
+if __name__ == '__main__':
+    test_signal_store()
@@ -1,8 +1,12 @@
 import chromatics
+import functools
+import io
 import json
 import os
 import pandas as pd
 
+from glob import glob
+
 def add_enhancer_distance_to_promoter(df, bin_count = None, bins = None):
     df['window_start'] = df[['promoter_end', 'enhancer_end']].min(axis = 1) + 1
     df['window_end'] = df[['promoter_start', 'enhancer_start']].max(axis = 1) - 1
@@ -42,7 +46,70 @@ def parse_config(config_fn):
         config['working_dir'] = os.path.dirname(config_fn)
     return config
 
+def get_signal_generators(signal_dir = '../signal', flank_sizes = None):
+    # signal stores written by generate_signal.py, relative to a config's working directory
+    # with flank_sizes, features of regions extended by each size are computed alongside the regions themselves
+    generator = chromatics.generate_prefix_sum_signal_features
+    if flank_sizes:
+        generator = functools.partial(chromatics.generate_flank_signal_features, flank_sizes = flank_sizes)
+    generators = []
+    for dataset in ['peaks', 'methylation', 'cage']:
+        store_dir = os.path.join(signal_dir, '{}.store'.format(dataset))
+        if os.path.exists(store_dir):
+            generators.append((generator, chromatics.load_signal_store(store_dir)))
+    return generators
+
+def get_domain_index(hic_dir = '../hi-c'):
+    # arrowhead domains, relative to a config's working directory, each given as a square on the contact map diagonal
+    domains_fn = glob(os.path.join(hic_dir, '*Arrowhead_domainlist.txt.gz'))[0]
+    domains_df = pd.read_csv(domains_fn, sep = '\t', usecols = ['chr1', 'x1', 'x2'])
+    domains_df.columns = chromatics.generic_bed_columns[:3]
+    domains_df['chrom'] = 'chr' + domains_df['chrom'].astype(str)
+    return chromatics.get_domain_index(domains_df)
+
+def parse_expression_values(values):
+    # rpkm1:rpkm2:idr triples parsed as numbers by the c parser rather than split as python strings
+    # missing values become blank lines, kept (and terminated, so a trailing one is not dropped) to parse as NaN
+    values = pd.Series(values, dtype = object).fillna('')
+    values_df = pd.read_csv(io.StringIO(''.join(_ + '\n' for _ in values)), sep = ':', header = None, names = expression_value_columns, skip_blank_lines = False)
+    for column in expression_value_columns:
+        values_df[column] = pd.to_numeric(values_df[column], errors = 'coerce')
+    return values_df
+
+def read_expression(expression_fn, cell_line, rna_extract = 'longPolyA', localization = 'cell', cache_dir = None):
+    # gencode expression for one cell line, one row per (gene, matching column)
+    # parsed results are pickled next to the source, keyed by its size and mtime so every config re-uses them
+    cache_dir = cache_dir or os.path.join(os.path.dirname(expression_fn), 'cache')
+    stat = os.stat(expression_fn)
+    cache_fn = os.path.join(cache_dir, '{}-{}-{}-{}-{}.pkl'.format(cell_line, rna_extract, localization, stat.st_size, stat.st_mtime_ns))
+    if os.path.exists(cache_fn):
+        return pd.read_pickle(cache_fn)
+
+    # cannot split on commas since a few localizations also use commas, don't really need lab ids so this is ok
+    header = pd.read_csv(expression_fn, sep = ' ', nrows = 0).columns
+    variables_df = header.drop('gene_id').to_series().str.split('[:.]', expand = True)
+    variables_df.columns = expression_variable_columns
+    variables_df = variables_df.query('rna_extract == @rna_extract and cell_line == @cell_line and localization == @localization')
+
+    # only the matching columns are parsed
+    expression_df = pd.read_csv(expression_fn, sep = ' ', usecols = ['gene_id'] + variables_df.index.tolist(), dtype = str)
+    expression_df = pd.melt(expression_df, id_vars = 'gene_id', value_vars = variables_df.index.tolist())
+    values_df = parse_expression_values(expression_df['value'].tolist())
+    expression_df = pd.concat([
+        expression_df[['gene_id']],
+        variables_df.loc[expression_df['variable']].reset_index(drop = True),
+        values_df
+        ], axis = 1).set_index('gene_id')
+
+    os.makedirs(cache_dir, exist_ok = True)
+    tmp_fn = '{}.{}.tmp'.format(cache_fn, os.getpid())
+    expression_df.to_pickle(tmp_fn)
+    os.replace(tmp_fn, cache_fn)
+    return expression_df
+
 # pipeline parameters
 min_enhancer_distance_to_promoter = 10000
 max_enhancer_distance_to_promoter = 2000000
 cell_lines = ['K562', 'GM12878', 'HeLa-S3', 'HUVEC', 'IMR90', 'NHEK', 'combined']
+expression_variable_columns = ['lab_ids', 'rna_extract', 'cell_line', 'localization']
+expression_value_columns = ['rpkm1', 'rpkm2', 'idr']
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import argparse
+import common
+import os
+import pandas as pd
+import pipeline
+import subprocess
+import sys
+import time
+
+def get_nodes(config_fns):
+    # one node per (config, stage) depending on the stages it requires
+    # equivalent nodes across configs of a cell line (same key) also wait for the first one, then restore its outputs
+    nodes = []
+    first_nodes = {}
+    for config_fn in config_fns:
+        config = common.parse_config(config_fn)
+        cell_line = config_fn.split('/')[0]
+        cache_dir = pipeline.get_cache_dir(config)
+        hashes = pipeline.load_hashes(cache_dir)
+        keys = {}
+        node_indices = {}
+        for stage in pipeline.stages:
+            key = pipeline.get_fingerprint(stage, config, cell_line, hashes, [keys[_] for _ in stage['requires']])
+            dependencies = [node_indices[_] for _ in stage['requires']]
+            if key in first_nodes:
+                dependencies.append(first_nodes[key])
+            else:
+                first_nodes[key] = len(nodes)
+            keys[stage['name']] = key
+            node_indices[stage['name']] = len(nodes)
+            nodes.append({
+                'config_fn': config_fn,
+                'working_dir': config['working_dir'],
+                'stage': stage,
+                'dependencies': dependencies,
+                'primary': first_nodes[key] == len(nodes)
+                })
+        os.makedirs(cache_dir, exist_ok = True)
+        pipeline.save_hashes(cache_dir, hashes)
+    return nodes
+
+def launch(node, n_jobs, force):
+    args = [sys.executable, os.path.join(pipeline.repo_dir, 'pipeline.py'), node['config_fn'], '--stages', node['stage']['name'], '--n-jobs', str(n_jobs)]
+    if force and node['primary']:
+        args.append('--force')
+    log_fn = os.path.join(node['working_dir'], '{}.log'.format(node['stage']['name']))
+    with open(log_fn, 'w') as log_file:
+        return subprocess.Popen(args, cwd = pipeline.repo_dir, stdout = log_file, stderr = subprocess.STDOUT)
+
+def run_nodes(nodes, cores, memory, stage_cores, force = False):
+    # start ready nodes while they fit the core and memory budgets, a node too large for either runs alone
+    # os.wait4 reaps whichever child finishes first and reports the largest peak rss of any single process among it
+    # and its reaped descendants, not their sum, so stages running several joblib workers use more than reported
+    pending = list(range(len(nodes)))
+    running = {}
+    finished = set()
+    failed = set()
+    records = []
+
+    while len(pending) > 0 or len(running) > 0:
+        for i in [i for i in pending if any(_ in failed for _ in nodes[i]['dependencies'])]:
+            pending.remove(i)
+            failed.add(i)
+            records.append([nodes[i]['config_fn'], nodes[i]['stage']['name'], 'skipped', 0.0, 0.0])
+
+        for i in list(pending):
+            node = nodes[i]
+            if not all(_ in finished for _ in node['dependencies']):
+                continue
+            node_cores = min(stage_cores, cores) if node['stage'].get('parallel', False) else 1
+            used_cores = sum(_['cores'] for _ in running.values())
+            used_memory = sum(nodes[_['index']]['stage']['memory'] for _ in running.values())
+            if len(running) > 0 and (used_cores + node_cores > cores or used_memory + node['stage']['memory'] > memory):
+                continue
+            process = launch(node, node_cores, force)
+            running[process.pid] = {'index': i, 'cores': node_cores, 'process': process, 'start_time': time.time()}
+            pending.remove(i)
+
+        if len(running) == 0:
+            continue
+        pid, status, rusage = os.wait4(-1, 0)
+        if pid not in running:
+            continue
+        task = running.pop(pid)
+        task['process'].returncode = os.waitstatus_to_exitcode(status)
+        node = nodes[task['index']]
+        if task['process'].returncode == 0:
+            finished.add(task['index'])
+        else:
+            failed.add(task['index'])
+        record = [node['config_fn'], node['stage']['name'], 'ok' if task['process'].returncode == 0 else 'failed', time.time() - task['start_time'], rusage.ru_maxrss / 2**20]
+        records.append(record)
+        print('{} {} {} {:.1f}s {:.2f}GB'.format(*record), flush = True)
+
+    return pd.DataFrame(records, columns = ['config_fn', 'stage', 'status', 'seconds', 'max_process_rss_gb'])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cell-lines', nargs = '+', default = common.cell_lines)
+    parser.add_argument('--configs', nargs = '+', default = ['ep', 'eep', 'epw'])
+    parser.add_argument('--cores', type = int, default = os.cpu_count())
+    parser.add_argument('--memory', type = float, default = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30, help = 'GB')
+    parser.add_argument('--stage-cores', type = int, help = 'cores given to each parallel stage, defaults to half of --cores')
+    parser.add_argument('--report', help = 'csv of per-stage wall time and max single-process rss')
+    parser.add_argument('--force', action = 'store_true')
+    args = parser.parse_args()
+
+    # config paths are relative to the repo directory, like generate_region.sh
+    os.chdir(pipeline.repo_dir)
+    config_fns = ['{}/{}.json'.format(cell_line, config) for cell_line in args.cell_lines for config in args.configs]
+    config_fns = [_ for _ in config_fns if os.path.exists(_)]
+    stage_cores = args.stage_cores if args.stage_cores is not None else max(1, args.cores // 2)
+
+    report_df = run_nodes(get_nodes(config_fns), args.cores, args.memory, stage_cores, args.force)
+    print(report_df.groupby('stage')[['seconds', 'max_process_rss_gb']].agg(['sum', 'max']))
+    if args.report is not None:
+        report_df.to_csv(args.report, index = False)
+    sys.exit(int((report_df['status'] != 'ok').any()))
@@ -7,12 +7,14 @@ import sys
 
 from glob import glob
 
+chromatics.instrument_script()
+
 config_fn = sys.argv[1]
 cell_line = config_fn.split('/')[0]
 config = common.parse_config(config_fn)
 os.chdir(os.path.expanduser(config['working_dir']))
 
-segmentation_df = chromatics.read_bed(glob('../segmentation/*.bed.gz')[0], usecols = range(4), names = chromatics.generic_bed_columns)
+segmentation_df = chromatics.read_typed_bed(glob('../segmentation/*.bed.gz')[0], chromatics.generic_bed_columns, usecols = chromatics.generic_bed_columns, cache = True)
 enhancer_states = {'E', 'WE', '13_EnhA1', '14_EnhA2', '16_EnhW1', '17_EnhW2'}
 enhancers_df = segmentation_df.query('name in @enhancer_states and (end - start) > 4').copy()
 enhancers_df.columns = chromatics.enhancer_bed_columns
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import chromatics
+import chromatics.modeling
+import common
+import os
+import pandas as pd
+import sklearn.externals.joblib as joblib
+import sys
+
+from sklearn.dummy import DummyClassifier
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.svm import LinearSVC
+from sklearn.tree import DecisionTreeClassifier
+
+chromatics.instrument_script()
+
+config_fn = sys.argv[1]
+cell_line = config_fn.split('/')[0]
+config = common.parse_config(config_fn)
+n_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else -1
+os.chdir(os.path.expanduser(config['working_dir']))
+
+fold_count = 10
+seed_count = 10
+estimators = {
+    'baseline': DummyClassifier(strategy = 'uniform', random_state = 0),
+    'gbm': GradientBoostingClassifier(n_estimators = 4000, learning_rate = 0.1, max_depth = 5, max_features = 'log2', random_state = 0),
+    'linear': LinearSVC(class_weight = 'balanced', random_state = 0),
+    'tree': DecisionTreeClassifier(random_state = 0)
+    }
+
+# predictors are written once as a float32 matrix next to the cached fits, both keyed by the training data and settings
+training_df = chromatics.read_training(config['training_fn'])
+predictors_df, labels = chromatics.modeling.get_modeling_data(training_df, config)
+del training_df
+cache_dir = os.path.join('model-cache', chromatics.modeling.get_modeling_key(config['training_fn'], config, fold_count))
+os.makedirs(cache_dir, exist_ok = True)
+predictors_fn = chromatics.modeling.share_predictors(predictors_df, os.path.join(cache_dir, 'predictors.npy'))
+folds = chromatics.modeling.get_folds(labels.values, fold_count)
+
+with joblib.Parallel(n_jobs) as parallel:
+    # predictions from each of the test sets, concatenated
+    for name, estimator in sorted(estimators.items()):
+        order, predictions = chromatics.modeling.cross_validate(predictors_fn, labels.values, folds, estimator, parallel, cache_dir)
+        predictions_df = pd.DataFrame({'label': labels.values[order], 'prediction': predictions}, index = labels.index[order], columns = ['label', 'prediction'])
+        predictions_df.to_csv('predictions-{}.csv'.format(name))
+        print(name, 'predictions')
+
+    importances_df = chromatics.modeling.get_feature_importances(predictors_fn, labels.values, predictors_df.columns, estimators['gbm'], seed_count, parallel, cache_dir)
+    importances_df.to_csv('feature_importances-gbm.csv')
+    print('gbm feature importances')
+
+    rfe_df = chromatics.modeling.eliminate_features(predictors_fn, labels.values, folds, estimators['gbm'], parallel, cache_dir)
+    rfe_df.to_csv('rfe-gbm.csv')
+    print('gbm rfe')
@@ -2,12 +2,15 @@
 
 import common
 import chromatics
+import numpy as np
 import os
 import pandas as pd
 import sys
 
 from glob import glob
 
+chromatics.instrument_script()
+
 config_fn = sys.argv[1]
 cell_line = config_fn.split('/')[0]
 config = common.parse_config(config_fn)
@@ -15,6 +18,8 @@ os.chdir(os.path.expanduser(config['working_dir']))
 
 distance_bin_count = 5
 negatives_per_bin = 20
+domain_candidates = config.get('domain_candidates')
+assert domain_candidates in [None, 'restrict', 'stratify']
 left_fragment_columns = ['f1_' + _ for _ in chromatics.generic_bed_columns]
 right_fragment_columns = ['f2_' + _ for _ in chromatics.generic_bed_columns]
 
@@ -41,7 +46,8 @@ positives_df = chromatics.get_interaction_elements(
     left_fragment_columns,
     right_fragment_columns,
     enhancers_df,
-    promoters_df)
+    promoters_df,
+    engine = 'sweep')
 
 # re-arrange columns so enhancer is always on the left
 positives_df = positives_df[chromatics.enhancer_bed_columns + chromatics.promoter_bed_columns + ['interaction_id']]
@@ -50,28 +56,63 @@ positives_df = positives_df[chromatics.enhancer_bed_columns + chromatics.promote
 common.add_enhancer_distance_to_promoter(positives_df)
 positives_df = positives_df.query('@common.min_enhancer_distance_to_promoter < enhancer_distance_to_promoter < @common.max_enhancer_distance_to_promoter')
 
+# optionally restrict all pairs to those within a single topological domain, or match the fraction of
+# negatives within one to the positives in each distance bin
+if domain_candidates is not None:
+    domain_index = common.get_domain_index()
+    positives_df['same_domain'] = chromatics.get_pairs_same_domain(domain_index, positives_df)
+    if domain_candidates == 'restrict':
+        positives_df = positives_df.query('same_domain').copy()
+
 # add distance bins
 positive_bins = common.add_enhancer_distance_to_promoter(positives_df, bin_count = distance_bin_count)
 positives_df['label'] = 1
 
-# generate negative candidates from all pairs of enhancers and active promoters
-negative_candidates_df = pd.merge(enhancers_df, promoters_df, left_on = 'enhancer_chrom', right_on = 'promoter_chrom')
-negative_candidates_df = negative_candidates_df.query('not (enhancer_name in @positives_df.enhancer_name and promoter_name in @positives_df.promoter_name)')
-print('enhancers: {} active promoters: {} negative candidate pairs: {}'.format(enhancers_df.shape[0], promoters_df.shape[0], negative_candidates_df.shape[0]))
-
-# cap interaction distance: distances outside positive bins will be assigned NA, so drop NAs
-common.add_enhancer_distance_to_promoter(negative_candidates_df, bins = positive_bins)
-negative_candidates_df.dropna(inplace = True)
+# count negative candidates per distance bin from sorted coordinates instead of building all pairs of enhancers and active promoters
+# positive pairs are excluded by (enhancer, promoter) key
+fewest_binned_positives = positives_df['bin'].value_counts().min()
+positive_pairs = (
+    pd.Index(enhancers_df['enhancer_name']).get_indexer(positives_df['enhancer_name']),
+    pd.Index(promoters_df['promoter_name']).get_indexer(positives_df['promoter_name']))
+if domain_candidates == 'stratify':
+    same_domain_fractions = positives_df.groupby('bin')['same_domain'].mean().reindex(positives_df['bin'].cat.categories).fillna(0).values
+    same_domain_negatives = np.round(fewest_binned_positives * negatives_per_bin * same_domain_fractions).astype(int)
+    samples = [
+        chromatics.sample_distance_matched_pairs(
+            enhancers_df,
+            promoters_df,
+            positive_bins,
+            samples_per_bin,
+            excluded_pairs = positive_pairs,
+            random_state = int(same_domain),
+            domain_index = domain_index,
+            same_domain = same_domain)
+        for same_domain, samples_per_bin in [(True, same_domain_negatives), (False, fewest_binned_positives * negatives_per_bin - same_domain_negatives)]]
+    negative_enhancers, negative_promoters = [np.concatenate(_) for _ in list(zip(*samples))[:2]]
+    negative_candidate_counts = samples[0][2]
+else:
+    negative_enhancers, negative_promoters, negative_candidate_counts = chromatics.sample_distance_matched_pairs(
+        enhancers_df,
+        promoters_df,
+        positive_bins,
+        fewest_binned_positives * negatives_per_bin,
+        excluded_pairs = positive_pairs,
+        random_state = 0,
+        domain_index = domain_index if domain_candidates == 'restrict' else None,
+        same_domain = True if domain_candidates == 'restrict' else None)
+print('enhancers: {} active promoters: {} negative candidate pairs: {}'.format(enhancers_df.shape[0], promoters_df.shape[0], negative_candidate_counts.sum()))
 
 print('\npositive distance bins:')
 print(positives_df['bin'].value_counts())
 
 print('\nnegative candidate distance bins:')
-print(negative_candidates_df['bin'].value_counts())
+print(pd.Series(negative_candidate_counts, index = positives_df['bin'].cat.categories))
 
 # distance match negatives to positives
-fewest_binned_positives = positives_df['bin'].value_counts().min()
-negatives_df = negative_candidates_df.groupby('bin', as_index = False).apply(lambda x: x.sample(fewest_binned_positives * negatives_per_bin, random_state = 0))
+negatives_df = chromatics.get_pairs_df(enhancers_df, promoters_df, negative_enhancers, negative_promoters)
+common.add_enhancer_distance_to_promoter(negatives_df, bins = positive_bins)
+if domain_candidates is not None:
+    negatives_df['same_domain'] = chromatics.get_pairs_same_domain(domain_index, negatives_df)
 negatives_df['label'] = 0
 
 # combine negatives with positives and remove potential overlap
@@ -96,6 +137,10 @@ print(pairs_df.groupby('label')['bin'].value_counts())
 print('\nclasses:')
 print(pairs_df['label'].value_counts())
 
+if domain_candidates is not None:
+    print('\nwithin one domain:')
+    print(pairs_df.groupby('label')['same_domain'].mean())
+
 print('\nenhancers per promoter (positives only):')
 print(pairs_df.query('label == 1').groupby('promoter_name')['enhancer_name'].nunique().describe())
 
@@ -106,14 +151,13 @@ pairs_df['window_chrom'] = pairs_df['enhancer_chrom']
 chromatics.add_names(pairs_df, chromatics.window_bed_columns, cell_line)
 
 # add a few useful features here -- positive interactions already in the window
-interactions_in_window_df = chromatics.bedtools('coverage -counts -F 1.0'.format(cell_line), pairs_df[chromatics.window_bed_columns], pairs_df.query('label == 1')[chromatics.window_bed_columns], left_names = chromatics.window_bed_columns, right_names = ['interactions_in_window']).iloc[:, -2:]
-assert len(pairs_df) == len(interactions_in_window_df)
-pairs_df = pd.merge(pairs_df, interactions_in_window_df, on = 'window_name')
+# counts are aligned with pairs_df by position, so coinciding windows need no join
+window_df = pairs_df[chromatics.window_bed_columns]
+pairs_df['interactions_in_window'] = chromatics.count_contained(window_df, window_df[pairs_df['label'].values == 1])
 
 # active genes skipped over by the loop
-active_promoters_in_window_df = chromatics.bedtools('coverage -counts'.format(cell_line), pairs_df[chromatics.window_bed_columns], promoters_df, left_names = chromatics.window_bed_columns, right_names = ['active_promoters_in_window']).iloc[:, -2:]
-assert len(pairs_df) == len(active_promoters_in_window_df)
-pairs_df = pd.merge(pairs_df, active_promoters_in_window_df, on = 'window_name').drop('interaction_id', axis = 1)
+pairs_df['active_promoters_in_window'] = chromatics.count_overlaps(window_df, promoters_df)
+pairs_df = pairs_df.drop('interaction_id', axis = 1)
 
 # save
 assert pairs_df.duplicated().sum() == 0
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import chromatics
+import chromatics.modeling
+import common
+import os
+import pandas as pd
+import sklearn.externals.joblib as joblib
+import sys
+
+from sklearn.ensemble import GradientBoostingClassifier
+
+chromatics.instrument_script()
+
+config_fn = sys.argv[1]
+cell_line = config_fn.split('/')[0]
+config = common.parse_config(config_fn)
+os.chdir(os.path.expanduser(config['working_dir']))
+
+model_fn = 'model-gbm.pkl'
+predictions_fn = 'predictions-genome.csv'
+batch_size = 2**16
+
+generators = common.get_signal_generators(flank_sizes = config.get('flank_sizes'))
+
+# fit a model on the labeled pairs unless one was saved by a previous run
+if os.path.exists(model_fn):
+    estimator, predictors = joblib.load(model_fn)
+else:
+    predictors_df, labels = chromatics.modeling.get_modeling_data(chromatics.read_training(config['training_fn']), config)
+    estimator = GradientBoostingClassifier(n_estimators = 4000, learning_rate = 0.1, max_depth = 5, max_features = 'log2', random_state = 0)
+    estimator.fit(predictors_df, labels)
+    predictors = predictors_df.columns.tolist()
+    joblib.dump((estimator, predictors), model_fn)
+    del predictors_df, labels
+
+enhancers_df = chromatics.read_bed('enhancers.bed', names = chromatics.enhancer_bed_columns)
+promoters_df = chromatics.read_bed('promoters.bed', names = chromatics.promoter_bed_columns)
+
+# score every enhancer-promoter candidate in the distance band, one bounded batch at a time
+# with domain candidates, pairs get the same_domain feature and are restricted like the training pairs
+domain_candidates = config.get('domain_candidates')
+candidates = chromatics.iter_candidate_pairs(
+    enhancers_df,
+    promoters_df,
+    common.min_enhancer_distance_to_promoter,
+    common.max_enhancer_distance_to_promoter,
+    batch_size,
+    domain_index = common.get_domain_index() if domain_candidates is not None else None,
+    same_domain_only = domain_candidates == 'restrict')
+for batch_number, pairs_df in enumerate(candidates):
+    common.add_enhancer_distance_to_promoter(pairs_df)
+    pairs_df['window_chrom'] = pairs_df['enhancer_chrom']
+    chromatics.add_names(pairs_df, chromatics.window_bed_columns, cell_line)
+
+    features_df = chromatics.generate_training(pairs_df, config['regions'], generators, chunk_size = 2**14, n_jobs = -1)
+    pairs_df['prediction'] = estimator.predict_proba(features_df.reindex(columns = predictors).fillna(0))[:, 1]
+
+    # save
+    prediction_columns = ['enhancer_name', 'promoter_name', 'enhancer_distance_to_promoter', 'prediction']
+    pairs_df[prediction_columns].to_csv(predictions_fn, mode = 'w' if batch_number == 0 else 'a', header = batch_number == 0, index = False)
+    print(batch_number, len(pairs_df))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import chromatics
+import common
+import os
+import pandas as pd
+import sys
+
+from glob import glob
+
+chromatics.instrument_script()
+
+config_fn = sys.argv[1]
+cell_line = config_fn.split('/')[0]
+config = common.parse_config(config_fn)
+os.chdir(os.path.expanduser(config['working_dir']))
+
+# preprocessed signal is shared by every config of a cell line
+os.makedirs('../signal', exist_ok = True)
+os.chdir('../signal')
+
+peaks_fn = 'peaks.bed.gz'
+methylation_fn = 'methylation.bed.gz'
+cage_fn = 'cage.bed.gz'
+peaks_store_dir = 'peaks.store'
+methylation_store_dir = 'methylation.store'
+cage_store_dir = 'cage.store'
+
+# preprocess peaks
+if os.path.exists('../peaks'):
+    assays = []
+    for name, filename, source, accession in pd.read_csv('../peaks/filenames.csv').itertuples(index = False):
+        columns = chromatics.narrowpeak_bed_columns if filename.endswith('narrowPeak') else chromatics.broadpeak_bed_columns
+        assay_df = chromatics.read_typed_bed('../peaks/{}.gz'.format(filename), columns, usecols = chromatics.generic_bed_columns + ['signal_value'], cache = True)
+        assay_df['name'] = name
+        assays.append(assay_df)
+    peaks_df = pd.concat(assays, ignore_index = True)
+    peaks_df['chrom'] = peaks_df['chrom'].astype('category')
+    chromatics.write_bed(peaks_df, peaks_fn, compression = 'gzip')
+    chromatics.build_signal_store(peaks_df, peaks_store_dir)
+
+# preprocess methylation
+if os.path.exists('../methylation'):
+    assays = [chromatics.read_typed_bed(_, chromatics.methylation_bed_columns, usecols = chromatics.generic_bed_columns + ['mapped_reads', 'percent_methylated'], cache = True) for _ in glob('../methylation/*.bed.gz')]
+    methylation_df = pd.concat(assays, ignore_index = True).query('mapped_reads >= 10 and percent_methylated > 0')
+    methylation_df['name'] = 'Methylation'
+    del methylation_df['mapped_reads']
+    chromatics.write_bed(methylation_df, methylation_fn, compression = 'gzip')
+    chromatics.build_signal_store(methylation_df, methylation_store_dir)
+
+# preprocess cage
+if os.path.exists('../cage'):
+    cage_df = chromatics.read_typed_bed(glob('../cage/*.bed.gz')[0], chromatics.cage_bed_columns, usecols = chromatics.cage_bed_columns[:5], cache = True)
+    cage_df['name'] = 'CAGE'
+    chromatics.write_bed(cage_df, cage_fn, compression = 'gzip')
+    chromatics.build_signal_store(cage_df, cage_store_dir)
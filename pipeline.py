@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+import argparse
+import chromatics
+import common
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+from glob import glob
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# stages of generate_region.sh in order, input globs (which must not match read_typed_bed caches) and outputs are relative to a config's working directory
+# requires lists the stages whose outputs a script reads, config_keys the settings it reads
+# so configs differing only elsewhere (ep and epw enhancers) share outputs
+# shared outputs live once per cell line and are only stamped, everything else is also copied to the stage cache
+# memory is a rough peak in GB used by generate_all.py, parallel scripts take n_jobs as a second argument
+# outputs of a stage are kept for its script to extend when the config enables its incremental setting
+stages = [
+    {'name': 'enhancers', 'script': 'generate_enhancers.py', 'inputs': ['../segmentation/*.bed.gz'], 'requires': [], 'config_keys': ['enhancer_extension_size'], 'outputs': ['enhancers.bed'], 'memory': 2},
+    {'name': 'promoters', 'script': 'generate_promoters.py', 'inputs': ['../segmentation/*.bed.gz', '../../expression/*.gz'], 'requires': [], 'config_keys': ['promoter_extension_size'], 'outputs': ['tss.bed', 'promoters.bed'], 'memory': 4},
+    {'name': 'pairs', 'script': 'generate_pairs.py', 'inputs': ['../hi-c/*looplist.txt.gz', '../hi-c/*Arrowhead_domainlist.txt.gz'], 'requires': ['enhancers', 'promoters'], 'config_keys': ['domain_candidates'], 'outputs': ['pairs.csv'], 'memory': 8},
+    {'name': 'signal', 'script': 'generate_signal.py', 'inputs': ['../peaks/filenames.csv', '../peaks/*.gz', '../methylation/*.bed.gz', '../cage/*.bed.gz'], 'requires': [], 'config_keys': [], 'outputs': ['../signal'], 'shared': True, 'memory': 8},
+    {'name': 'training', 'script': 'generate_training.py', 'inputs': [], 'requires': ['pairs', 'signal'], 'config_keys': ['regions', 'flank_sizes', 'stream_training', 'incremental_training'], 'outputs': ['training.h5'], 'parallel': True, 'incremental': 'incremental_training', 'memory': 16}
+    ]
+stage_indices = {stage['name']: i for i, stage in enumerate(stages)}
+code_fns = ['common.py'] + sorted(os.path.relpath(_, repo_dir) for _ in glob(os.path.join(repo_dir, 'chromatics', '*.py')))
+
+def get_cache_dir(config):
+    return os.path.normpath(os.path.join(config['working_dir'], '..', 'stage-cache'))
+
+def write_json(obj, fn):
+    # write then rename so concurrent readers never see a partial file
+    tmp_fn = '{}.{}.tmp'.format(fn, os.getpid())
+    with open(tmp_fn, 'w') as tmp_file:
+        json.dump(obj, tmp_file)
+    os.replace(tmp_fn, fn)
+
+def iter_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    yield os.path.join(dirpath, filename)
+        elif os.path.exists(path):
+            yield path
+
+def hash_file(fn, hashes):
+    # content hashes are memoized by (size, mtime) so unchanged inputs are never re-read
+    stat = os.stat(fn)
+    key = os.path.abspath(fn)
+    if key in hashes and hashes[key][:2] == [stat.st_size, stat.st_mtime_ns]:
+        return hashes[key][2]
+    digest = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    hashes[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return hashes[key][2]
+
+def get_fingerprint(stage, config, cell_line, hashes, upstream_keys = None):
+    # stage name, code version, relevant settings, and input contents
+    # with upstream_keys, required outputs are represented by the keys of the stages producing them,
+    # which identifies equivalent stages before their inputs exist
+    working_dir = config['working_dir']
+    digest = hashlib.sha256()
+    digest.update(json.dumps([stage['name'], cell_line, {key: config.get(key) for key in stage['config_keys']}], sort_keys = True).encode())
+    for fn in [stage['script']] + code_fns:
+        digest.update('{} {}\n'.format(fn, hash_file(os.path.join(repo_dir, fn), hashes)).encode())
+    paths = [path for pattern in stage['inputs'] for path in sorted(glob(os.path.join(working_dir, pattern)))]
+    if upstream_keys is None:
+        paths += [os.path.join(working_dir, output) for name in stage['requires'] for output in stages[stage_indices[name]]['outputs']]
+    else:
+        digest.update(json.dumps(upstream_keys).encode())
+    for fn in iter_files(paths):
+        digest.update('{} {}\n'.format(os.path.relpath(fn, working_dir), hash_file(fn, hashes)).encode())
+    return digest.hexdigest()
+
+def load_hashes(cache_dir):
+    hashes_fn = os.path.join(cache_dir, 'hashes.json')
+    return json.load(open(hashes_fn)) if os.path.exists(hashes_fn) else {}
+
+def save_hashes(cache_dir, hashes):
+    # concurrent stages may drop each other's entries, which only costs re-hashing
+    write_json(hashes, os.path.join(cache_dir, 'hashes.json'))
+
+def get_stamp_fn(cache_dir, output_fns):
+    # one stamp per output set, recording the fingerprint that produced it
+    key = hashlib.sha256('\n'.join(output_fns).encode()).hexdigest()
+    return os.path.join(cache_dir, 'stamps', key)
+
+def remove_outputs(output_fns):
+    for fn in output_fns:
+        if os.path.isdir(fn):
+            shutil.rmtree(fn)
+        elif os.path.exists(fn):
+            os.remove(fn)
+
+def copy_outputs(src_fns, dst_fns):
+    for src_fn, dst_fn in zip(src_fns, dst_fns):
+        if os.path.isdir(src_fn):
+            shutil.copytree(src_fn, dst_fn)
+        else:
+            shutil.copy2(src_fn, dst_fn)
+
+def run_stage(stage, config_fn, force = False, n_jobs = None):
+    # returns 'current', 'restored', or 'ran'
+    config = common.parse_config(config_fn)
+    cell_line = config_fn.split('/')[0]
+    cache_dir = get_cache_dir(config)
+    os.makedirs(os.path.join(cache_dir, 'stamps'), exist_ok = True)
+    hashes = load_hashes(cache_dir)
+
+    fingerprint = get_fingerprint(stage, config, cell_line, hashes)
+    output_fns = [os.path.abspath(os.path.join(config['working_dir'], _)) for _ in stage['outputs']]
+    stamp_fn = get_stamp_fn(cache_dir, output_fns)
+    entry_dir = os.path.join(cache_dir, '{}-{}'.format(stage['name'], fingerprint))
+    entry_fns = [os.path.join(entry_dir, os.path.basename(_)) for _ in output_fns]
+
+    # outputs already in place
+    if not force and os.path.exists(stamp_fn) and open(stamp_fn).read() == fingerprint and all(os.path.exists(_) for _ in output_fns):
+        status = 'current'
+
+    # outputs produced earlier, possibly by another config of this cell line
+    elif not force and os.path.isdir(entry_dir):
+        remove_outputs(output_fns)
+        copy_outputs(entry_fns, output_fns)
+        status = 'restored'
+
+    else:
+        if not config.get(stage.get('incremental'), False):
+            remove_outputs(output_fns)
+        args = [os.path.join(repo_dir, stage['script']), config_fn]
+        if stage.get('parallel', False) and n_jobs is not None:
+            args.append(str(n_jobs))
+        subprocess.check_call(args, cwd = repo_dir)
+        if not stage.get('shared', False):
+            # copy to a temporary directory first so an interrupted copy is never mistaken for a cache entry
+            tmp_dir = '{}.{}.tmp'.format(entry_dir, os.getpid())
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+            os.makedirs(tmp_dir)
+            copy_outputs(output_fns, [os.path.join(tmp_dir, os.path.basename(_)) for _ in output_fns])
+            shutil.rmtree(entry_dir, ignore_errors = True)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # an equivalent stage filled the entry first
+                shutil.rmtree(tmp_dir)
+        status = 'ran'
+
+    with open(stamp_fn, 'w') as stamp_file:
+        stamp_file.write(fingerprint)
+    for fn in iter_files(output_fns):
+        hash_file(fn, hashes)
+    save_hashes(cache_dir, hashes)
+    return status
+
+def run_pipeline(config_fn, stage_names = None, force = False, n_jobs = None):
+    for stage in stages:
+        if stage_names is None or stage['name'] in stage_names:
+            with chromatics.time_event('stage', stage = stage['name'], config_fn = config_fn) as fields:
+                fields['status'] = run_stage(stage, config_fn, force, n_jobs)
+            print(stage['name'], fields['status'], flush = True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_fn')
+    parser.add_argument('--stages', nargs = '+', choices = [_['name'] for _ in stages])
+    parser.add_argument('--force', action = 'store_true')
+    parser.add_argument('--n-jobs', type = int)
+    parser.add_argument('--events', help = 'json lines file receiving timing and memory events, appended to')
+    parser.add_argument('--profile-dir', help = 'directory receiving a cProfile dump of each script')
+    args = parser.parse_args()
+
+    # stage scripts inherit instrumentation settings through the environment, options override it
+    chromatics.configure_instrumentation(args.events or os.environ.get(chromatics.events_variable), args.profile_dir or os.environ.get(chromatics.profile_variable))
+    # config paths are relative to the repo directory, like generate_region.sh
+    os.chdir(repo_dir)
+    run_pipeline(args.config_fn, args.stages, args.force, args.n_jobs)
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
 import gzip
-import pandas as pd
+import os
 import sys
 
+# run from the repo directory, like the generate scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import chromatics
+
 cell_line = sys.argv[1]
 region = sys.argv[2]
 
-training_df = pd.read_hdf('{}/output-{}/training.h5'.format(cell_line, region), 'training')
+# joins feature columns added by incremental training
+training_df = chromatics.read_training('{}/output-{}/training.h5'.format(cell_line, region))
 training_df.to_csv(gzip.open('{}/output-{}/training.csv.gz'.format(cell_line, region), 'wt'), index = False)